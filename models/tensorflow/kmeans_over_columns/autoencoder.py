@@ -20,13 +20,30 @@ import math
 import matplotlib.pyplot as plt
 from operator import mul,add
 from scipy import stats
+from collections import OrderedDict
 
 EPSILON  = 0.0000001
 
+#Activation functions that can be exported by name
+ACTIVATIONS = {'sigmoid':tf.sigmoid, 'relu':tf.nn.relu, 'tanh':tf.tanh}
+
+def activation_name(f):
+  for name,g in ACTIVATIONS.iteritems():
+    if f is g:
+      return name
+  raise ValueError("Activation function {} can not be exported".format(f))
+
 class LayerDef():
   
   def __init__(self,params):
-    self.lr = params.get('lr',0.1)
+    #Optimization of the stage that adds this layer.  A learning rate of None uses the optimizer's default.
+    self.lr = params.get('lr',None)
+    self.optimizer = params.get('optimizer','momentum')
+    self.momentum = params.get('momentum',None)
+    self.lr_schedule = params.get('lr_schedule',None)
+    self.decay_steps = params.get('decay_steps',1000)
+    self.decay_rate = params.get('decay_rate',0.1)
+    self.warmup_steps = params.get('warmup_steps',0)
     self.ALPHA = params.get('ALPHA',0.0)
     self.sparsity_target = params.get('sparsity_target',0.01)
     self.sparsity_lr = params.get('sparsity_lr',0.0)
@@ -134,14 +151,60 @@ class Layer(object):
 
 class DataLayer(Layer):
     
-  def __init__(self,dp,g):
+  def __init__(self,dp,g, preload=False):
       self.dp = dp
+      self.preload = preload
       with g.as_default():
-        self.datalayer = tf.placeholder(tf.float32, dp.shape(), "data")
+        if preload:
+          self.build_preloaded()
+        else:
+          self.datalayer = tf.placeholder(tf.as_dtype(dp.dtype), [None]+list(dp.shape()[1:]), "data")
       self._recon = None
       self._recon = None
       self._inject_recon = None
 
+  def build_preloaded(self):
+      '''
+      Holds the whole dataset in a graph variable and draws minibatches from it with an index tensor.
+      The indices follow an on-graph cursor unless they are fed explicitly.
+      Each batch gets one random crop, as in the providers' get_mb.
+      '''
+      self._dataset_value = self.dp.get_dataset()[0]
+      self._dataset_feed = tf.placeholder(tf.as_dtype(self._dataset_value.dtype), self._dataset_value.shape, "dataset_feed")
+      self.dataset = tf.Variable(self._dataset_feed, trainable=False, name="dataset")
+      self.cursor = tf.Variable(0, trainable=False, name="cursor")
+      self.indices, self.datalayer = self.batch_at(self.cursor)
+      with tf.control_dependencies([self.datalayer]):
+        self.advance = self.advance_from(self.cursor)
+
+  def batch_at(self, cursor):
+      '''
+      Builds the randomly cropped batch of the preloaded dataset starting at cursor.
+      @return: (indices, batch)
+      '''
+      shape = self.dp.shape()
+      full_shape = self.dataset.get_shape().as_list()
+      indices = tf.mod(cursor + tf.range(0, shape[0]), full_shape[0])
+      batch = tf.gather(self.dataset, indices)
+      offsets = [tf.to_int32(tf.floor(tf.random_uniform([], 0, full_shape[i]-shape[i]+1))) for i in (1,2)]
+      batch = tf.slice(batch, tf.pack([0]+offsets+[0]), [-1, shape[1], shape[2], shape[3]])
+      batch.set_shape([None]+list(shape[1:]))
+      return (indices, batch)
+
+  def advance_from(self, cursor):
+      '''
+      Moves the cursor one batch past the given cursor value.
+      '''
+      return tf.assign(self.cursor, tf.mod(cursor + self.dp.shape()[0], self.dataset.get_shape().as_list()[0]))
+
+  def initialize(self, s):
+      '''
+      Copies the preloaded dataset into its graph variable.
+      '''
+      if self.preload:
+        s.run([self.dataset.initializer, self.cursor.initializer], feed_dict={self._dataset_feed:self._dataset_value})
+        self._dataset_value = None
+
 
   def get_top(self):
       '''
@@ -175,7 +238,39 @@ class FeedThroughLayer(Layer):
       self._uid = uid
       self._freeze = freeze
       self._params = []
+      self._weights = []
+      self._constants = None
       
+  def set_constants(self, values):
+      '''
+      Supplies fixed values for this layer's weights, in the order of weights().
+      The layer then builds its weights as graph constants instead of Variables.
+      Tensors are used as they are, so a copy of a layer can compute with the weights of the original.
+      '''
+      self._constants = list(values)
+
+  def make_param(self, initializer, name=None):
+      '''
+      Creates one weight of this layer, either as a Variable initialized by initializer() or as a supplied constant.
+      '''
+      if self._constants:
+        value = self._constants.pop(0)
+        if isinstance(value, (tf.Tensor, tf.Variable)):
+          return value
+        return tf.constant(value, name=name)
+      return tf.Variable(initializer(), name=name)
+
+  def cast(self, w, x):
+      '''
+      Casts a weight to the type of the activations x it is applied to.
+      Weights are kept in float32 while activations may be float16.
+      '''
+      return tf.cast(w, x.dtype.base_dtype)
+
+  def set_weights(self, weights):
+      self._weights = weights
+      self._params = [w for w in weights if isinstance(w, tf.Variable)]
+
   def set_bottom(self,l):
       '''
       :param l: The layer that feeds into this one
@@ -214,6 +309,18 @@ class FeedThroughLayer(Layer):
   def params(self):
     return self._params  
   
+  def weights(self):
+    '''
+    The tensors holding this layer's weights, whether trainable Variables or frozen constants.
+    '''
+    return self._weights
+  
+  def export(self):
+    '''
+    Describes this layer for inference outside of TensorFlow, or None if it is not needed at inference.
+    '''
+    return None
+  
   def uid(self):
     return self._uid 
   
@@ -232,8 +339,7 @@ class CorruptionLayer(FeedThroughLayer):
       '''
       with self.g.as_default():
         if self.d : 
-          self._indim = self._bottom.get_shape().as_list()
-          inflat = reduce(mul,self._indim[1:])
+          self._indim = tf.shape(self._bottom)
           self.noise = tf.random_uniform(self._indim,
                                          minval = -1,
                                          maxval = 1,
@@ -242,9 +348,10 @@ class CorruptionLayer(FeedThroughLayer):
                                              minval = 0,
                                              maxval = 1,
                                              dtype=tf.float32)
-          self.mask = tf.to_float(self.p < self.d.corruptionlevel())
-          self.invmask = tf.to_float(self.p >= self.d.corruptionlevel())
-          self._top = tf.mul(self._bottom,self.invmask) + tf.mul(self.noise, self.mask)
+          dtype = self._bottom.dtype.base_dtype
+          self.mask = tf.cast(self.p < self.d.corruptionlevel(), dtype)
+          self.invmask = tf.cast(self.p >= self.d.corruptionlevel(), dtype)
+          self._top = tf.mul(self._bottom,self.invmask) + tf.mul(tf.cast(self.noise, dtype), self.mask)
 
     
 
@@ -256,8 +363,8 @@ class FCLayer(FeedThroughLayer):
       Constructs the computation graph for this layer and all subsequent encode_layers.
       '''
       with self.g.as_default():
-        self.W = tf.Variable(
-                             tf.random_uniform([din, dout],
+        self.W = self.make_param(
+                             lambda: tf.random_uniform([din, dout],
                                                minval=-4.0*math.sqrt(6.0/(din+ dout)),
                                                maxval=4.0*math.sqrt(6.0/(din+ dout)),
                                                dtype=tf.float32
@@ -268,41 +375,46 @@ class FCLayer(FeedThroughLayer):
       d_in = self._bottom.get_shape().as_list()
       d_flat = reduce(mul,d_in[1:])
       self.init(d_flat,self.d.outdim_flat())
-      self.bias = tf.Variable(
-                              tf.zeros([self.d.outdim_flat()]),
+      self.bias = self.make_param(
+                              lambda: tf.zeros([self.d.outdim_flat()]),
                               name='bias_'+str(self._uid)
                               )
-      flat_in = tf.reshape(self._bottom,[d_in[0],-1])
+      flat_in = tf.reshape(self._bottom,[-1,d_flat])
       self._top = self.d.activation_function(
                                              tf.add(
                                                     tf.matmul(
                                                               flat_in,
-                                                              self.W
+                                                              self.cast(self.W, flat_in)
                                                               ),
-                                                    self.bias
+                                                    self.cast(self.bias, flat_in)
                                                     )
                                              )
-      self._params = [self.W, self.bias]
+      self.set_weights([self.W, self.bias])
        
     def build_back(self):
       d_in = self._embedding.get_shape().as_list()
       d_flat = reduce(mul,d_in[1:])
       self.init(self.d.outdim_flat(),d_flat)      
-      self.rev_bias = tf.Variable(
-                              tf.zeros([self.d.outdim_flat()]),
+      self.rev_bias = self.make_param(
+                              lambda: tf.zeros([self.d.outdim_flat()]),
                               name='rev_bias_'+str(self._uid)
                               )
       self._inject_recon = self._compute_back(self._inject_embedding)
       self._recon = self._compute_back(self._embedding)
-      self._params = [self.W, self.rev_bias]
+      self.set_weights([self.W, self.rev_bias])
+    
+    def export(self):
+      return {'type':'fc',
+              'outdim':self.d.outdim(),
+              'activation':activation_name(self.d.activation_function)}
     
     def _compute_back(self,top):
       with self.g.as_default():
-        flat_top = tf.reshape(top, [top.get_shape().as_list()[0], -1])
-        sum_input = tf.matmul(flat_top, tf.transpose(self.W))
-        sum_input_w_bias = tf.add(sum_input,self.rev_bias)
+        flat_top = tf.reshape(top, [-1, reduce(mul,top.get_shape().as_list()[1:])])
+        sum_input = tf.matmul(flat_top, tf.transpose(self.cast(self.W, flat_top)))
+        sum_input_w_bias = tf.add(sum_input,self.cast(self.rev_bias, flat_top))
         activation = self.d.activation_function(sum_input_w_bias)
-        output_shape = [top.get_shape().as_list()[0]]+self.d.outdim()
+        output_shape = [-1]+self.d.outdim()
         print(output_shape)
         return tf.reshape( activation, shape=output_shape)
 
@@ -321,28 +433,28 @@ class ConvLayer(FeedThroughLayer):
           else:
             var_prefix = 'decode_' 
           dims = self.d.filterdim()+[cbottom, ctop]
-          self.W = tf.Variable(
-                               tf.truncated_normal(dims,
+          self.W = self.make_param(
+                               lambda: tf.truncated_normal(dims,
                                                  stddev=math.sqrt(3.0/(reduce(mul,self.d.filterdim()))),
                                                  dtype=tf.float32
                                                  ),
                                name=var_prefix+'W_'+str(self._uid))
           if fwd:
-            self.bias = tf.Variable(
-                                   tf.zeros([ctop],
+            self.bias = self.make_param(
+                                   lambda: tf.zeros([ctop],
                                             name=var_prefix+'bias_'+str(self._uid))
                                     )
           else:
-            self.bias = tf.Variable(
-                                   tf.zeros([cbottom],
+            self.bias = self.make_param(
+                                   lambda: tf.zeros([cbottom],
                                             name=var_prefix+'rev_bias_'+str(self._uid))
                                     )
-          self._params = [self.W, self.bias]
+          self.set_weights([self.W, self.bias])
           
     def build_fwd(self):
       cin = self._bottom.get_shape().as_list()[-1]
       self.init(cin, self.d.outdim(),True)
-      self._top = self.d.activation_function(tf.nn.conv2d(self._bottom, self.W, self.d.strides(),self.d._padding, name="Conv_"+str(self._uid)+"_top")+self.bias)
+      self._top = self.d.activation_function(tf.nn.conv2d(self._bottom, self.cast(self.W, self._bottom), self.d.strides(),self.d._padding, name="Conv_"+str(self._uid)+"_top")+self.cast(self.bias, self._bottom))
  
         
     def build_back(self):
@@ -351,14 +463,23 @@ class ConvLayer(FeedThroughLayer):
       self._inject_recon = self._compute_back(self._inject_embedding)
       self._recon = self._compute_back(self._embedding)
         
+    def export(self):
+      return {'type':'conv',
+              'filterdim':self.d.filterdim(),
+              'strides':self.d.strides(),
+              'padding':self.d._padding,
+              'outdim':self.d.outdim(),
+              'activation':activation_name(self.d.activation_function)}
+        
     def _compute_back(self, top):
       with self.g.as_default():
         inshape = top.get_shape().as_list()
-        outshape = [inshape[0], 
-                    (inshape[1]-1)*self.d.strides()[1] + self.d.filterdim()[0] , 
+        outshape = [(inshape[1]-1)*self.d.strides()[1] + self.d.filterdim()[0] , 
                     (inshape[2]-1)*self.d.strides()[2] + self.d.filterdim()[1] ,
                     self.d.outdim()]
-        return self.d.activation_function(tf.nn.deconv2d(top, self.W, outshape, self.d.strides(), padding=self.d._padding)+self.bias)
+        recon = tf.nn.deconv2d(top, self.cast(self.W, top), tf.pack([tf.shape(top)[0]]+outshape), self.d.strides(), padding=self.d._padding)
+        recon.set_shape([None]+outshape)
+        return self.d.activation_function(recon+self.cast(self.bias, top))
           
 
 
@@ -400,8 +521,128 @@ def cross_entropy(p, p_hat):
   b = tf.mul((1-p),tf.log(1-p_hat+EPSILON))
   return a+b
 
+"""
+=============  Optimization ============
+"""
+#Learning rates used when a LayerDef does not set one.  The momentum optimizer uses AutoEncoder.LEARNING_RATE.
+DEFAULT_LEARNING_RATES = {'adam':0.001, 'rmsprop':0.001}
+
+def learning_rate(definition, base_lr, global_step):
+  """
+  Builds the learning rate of a stage from its LayerDef.
+  
+  @param: definition The LayerDef of the layer the stage adds.
+          lr_schedule is None for a constant rate, or one of:
+            'step' multiplies the rate by decay_rate every decay_steps steps,
+            'exponential' decays it continuously by decay_rate per decay_steps steps,
+            'cosine' anneals it to zero over decay_steps steps.
+          The rate ramps up linearly over the first warmup_steps steps.
+  @param: base_lr The initial learning rate.
+  @param: global_step The step counter of the stage.
+  """
+  step = tf.to_float(global_step)
+  if definition.lr_schedule is None:
+    lr = tf.constant(base_lr)
+  elif definition.lr_schedule in ('step', 'exponential'):
+    lr = tf.train.exponential_decay(base_lr, global_step, definition.decay_steps, definition.decay_rate,
+                                    staircase=definition.lr_schedule == 'step')
+  elif definition.lr_schedule == 'cosine':
+    progress = tf.minimum(step, float(definition.decay_steps))/definition.decay_steps
+    lr = 0.5*base_lr*(1.0+tf.cos(math.pi*progress))
+  else:
+    raise ValueError("Unknown learning rate schedule {}".format(definition.lr_schedule))
+  if definition.warmup_steps > 0:
+    lr *= tf.minimum(1.0, (step+1.0)/definition.warmup_steps)
+  return lr
+
+def make_optimizer(name, lr, momentum):
+  if name == 'momentum':
+    return tf.train.MomentumOptimizer(lr, momentum, use_locking=True)
+  if name == 'adam':
+    return tf.train.AdamOptimizer(lr, use_locking=True)
+  if name == 'rmsprop':
+    return tf.train.RMSPropOptimizer(lr, momentum=momentum, use_locking=True)
+  raise ValueError("Unknown optimizer {}".format(name))
+
+"""
+=============  Checkpoint Cache ============
+"""
+#Number of checkpoint files held at once.  A layer's encode and decode files for the general and a column specific checkpoint.
+CHECKPOINT_CACHE_SIZE = 4
+_checkpoint_cache = OrderedDict()
+
+def read_checkpoint(filename):
+  """
+  Reads every tensor held in a checkpoint file into a dictionary of numpy arrays keyed by variable name.
+  Files are cached by path and modification time so a checkpoint shared by many columns is only deserialized once.
+  The least recently read files are evicted beyond CHECKPOINT_CACHE_SIZE.
+  
+  @param: filename The checkpoint file to read.
+  """
+  filename = path.abspath(filename)
+  key = (filename, os.path.getmtime(filename))
+  if key in _checkpoint_cache:
+    _checkpoint_cache[key] = _checkpoint_cache.pop(key)
+  else:
+    for stale in [k for k in _checkpoint_cache.keys() if k[0] == filename]:
+      del _checkpoint_cache[stale]
+    reader = tf.train.NewCheckpointReader(filename)
+    _checkpoint_cache[key] = dict([(name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map()])
+    while len(_checkpoint_cache) > CHECKPOINT_CACHE_SIZE:
+      _checkpoint_cache.popitem(last=False)
+  return _checkpoint_cache[key]
+
+def clear_checkpoint_cache():
+  """
+  Releases every cached checkpoint.  Call once all columns have restored a layer.
+  """
+  _checkpoint_cache.clear()
+
 
 
+"""
+=============  Dataset Scoring ============
+"""
+def score_columns(columns, dp, filename=None, observers=None):
+  """
+  Computes the per example reconstruction loss of every column over the whole data provider in a single pass.
+  The final partial minibatch is scored as well.
+  Any batch size can be used since the layer stack has a dynamic batch dimension.
+  
+  @param: columns A list of AutoEncoders to score.
+  @param: dp The data provider to stream.
+  @param: filename If given, results are written to a memory mapped .npy file at this path.
+  @param: observers Objects whose update(data, keys, scores, tops, recons) is called for every minibatch,
+                    with the minibatch's scores and each column's tops and reconstructions from the same run.
+                    Tops and reconstructions are only fetched, otherwise None, if an observer's outputs attribute is True.
+  @return: A float32 array [n_examples, len(columns)] indexed by the example's position in dp.get_keys().
+  """
+  shape = (dp.get_n_examples(), len(columns))
+  if filename:
+    scores = numpy.lib.format.open_memmap(filename, mode='w+', dtype=numpy.float32, shape=shape)
+  else:
+    scores = numpy.zeros(shape, dtype=numpy.float32)
+  i = 0
+  for mb in dp.get_mb(tail=True):
+    data = mb[0]
+    n = len(data)
+    if observers and any([o.outputs for o in observers]):
+      tops = []
+      recons = []
+      for c,column in enumerate(columns):
+        scores[i:i+n,c],top,recon = column.fwd_back_loss(data)
+        tops.append(top)
+        recons.append(recon)
+      for o in observers:
+        o.update(data, mb[2], scores[i:i+n], tops, recons)
+    else:
+      for c,column in enumerate(columns):
+        scores[i:i+n,c] = column.per_example_reconstruction_loss(data)
+      for o in observers or []:
+        o.update(data, mb[2], scores[i:i+n], None, None)
+    i += n
+  return scores
+
 """
 =============  Autoencoder Container ============
 """
@@ -410,7 +651,7 @@ def cross_entropy(p, p_hat):
 
 class AutoEncoder(object):
     
-    def __init__(self,s,g, dp, log_path, checkpoint_path, colnum=-1):
+    def __init__(self,s,g, dp, log_path, checkpoint_path, colnum=-1, preload=False, layerwise=False):
         self.dp = dp
         self.s = s
         self.g = g
@@ -418,16 +659,24 @@ class AutoEncoder(object):
         self.checkpoint_path = checkpoint_path
         self.coluid = colnum
         self.layeruid = 0
-        self.encode_layers = [DataLayer(self.dp,g)]
+        self.encode_layers = [DataLayer(self.dp,g, preload)]
+        self.encode_layers[0].initialize(s)
         self.decode_layers = []
+        self._decode_start = 0
         self.bottom_feed = self.encode_layers[0].bottom_feed()
         self.LEARNING_RATE=0.9
         self.MOMENTUM = 0.9
+        self.LOSS_SCALE = 128.0 # Only used with float16 data
         self.ALPHA = 0.0 # mnist: 0.3
         self.freeze = False
         self.summaryid = 0
         self.summarize = False
+        self.SUMMARY_INTERVAL = 100
+        self.UNROLL_STEPS = 10 # Training steps chained into one session run by train_steps
+        self.stepid = 0
         self.isDecoderValid = False
+        self.layerwise = layerwise
+        self._assign_ops = {}
 
     def get_checkpoint_file(self,coluid=0,layeruid=0,encode=True):
       prefix = ''
@@ -467,21 +716,45 @@ class AutoEncoder(object):
       with self.g.as_default():
         for params,encoder, i in zip((encodeparams,decodeparams), (True, False),(0,1)):
           if len(params) > 0:
-                #         paramsdict = {w.name.strip(":[0..9]+"):w for w in params}
-            saver = tf.train.Saver(params)
             column_specific_file = self.get_checkpoint_file(self.coluid, self.layeruid, encoder)
             general_file = self.get_checkpoint_file(-1, self.layeruid, encoder)
             if os.path.isfile(column_specific_file):
-              saver.restore(self.s,column_specific_file)
+              self.restore_file(params, column_specific_file)
               restorefiles[i] = column_specific_file
             elif os.path.isfile(general_file):
-              saver.restore(self.s,general_file)
+              self.restore_file(params, general_file)
               restorefiles[i] = general_file
       return restorefiles
 
+    def restore_file(self, params, filename):
+      """
+      Restores params from a checkpoint file through the shared checkpoint cache.
+      Falls back to a Saver if the file does not hold every parameter by name.
+      """
+      values = read_checkpoint(filename)
+      if all(p.op.name in values for p in params):
+        self.assign(params, [values[p.op.name] for p in params])
+      else:
+        tf.train.Saver(params).restore(self.s, filename)
+
+    def assign(self, params, values):
+      """
+      Assigns numpy values to variables in a single session run.
+      The placeholders and assign ops are built once per list of variables and reused.
+      """
+      key = tuple(params)
+      if key not in self._assign_ops:
+        with self.g.as_default():
+          placeholders = [tf.placeholder(p.dtype.base_dtype, p.get_shape()) for p in params]
+          self._assign_ops[key] = (placeholders, tf.group(*[tf.assign(p, ph) for p,ph in zip(params, placeholders)]))
+      placeholders, assignments = self._assign_ops[key]
+      self.s.run(assignments, feed_dict=dict(zip(placeholders, values)))
+
     def add_layer(self,definition, freeze=True):
+      self.save()
+      if self.layerwise and all([l.freeze() for l in self.encode_layers]):
+        self.rebuild_frozen()
       with self.g.as_default():
-        self.save()
         #Get hyperparameters
         self.layeruid+=1
         
@@ -496,13 +769,41 @@ class AutoEncoder(object):
         
         
         
+    def rebuild_frozen(self):
+      """
+      Moves the column into a fresh graph and session holding only the data layer and the frozen encoder layers, 
+      whose weights become graph constants.
+      Decoders, optimizers and summaries of earlier stages stay behind in the old graph.
+      """
+      values = [self.s.run(l.weights()) if l.weights() else [] for l in self.encode_layers[1:]]
+      old_layers = self.encode_layers[1:]
+      preload = self.encode_layers[0].preload
+      self.s.close()
+      self.g = tf.Graph()
+      self.s = tf.Session(graph=self.g)
+      self._assign_ops = {}
+      with self.g.as_default():
+        self.encode_layers = [DataLayer(self.dp,self.g, preload)]
+        self.encode_layers[0].initialize(self.s)
+        self.bottom_feed = self.encode_layers[0].bottom_feed()
+        for old,v in zip(old_layers, values):
+          l = old.d.instance(self.g, old.uid(), True)
+          l.set_constants(v)
+          l.set_bottom(self.encode_layers[-1].get_top())
+          self.encode_layers.append(l)
+          l.build_fwd()
+        self._top = self.encode_layers[-1].get_top()
+      self.decode_layers = []
+      self.isDecoderValid = False
+        
     def set_decode(self, decode_layerdefs):
       with self.g.as_default():
+        self._decode_start = len(self.decode_layers)
         #establish first decoder layer
         l = decode_layerdefs[0].instance(self.g,str(self.layeruid)+"_"+str(1), False)
         #tie top of encoder and top of injection path to decoder layer 1
         self.decode_layers.append(l)
-        self.injection = tf.placeholder(tf.float32, self._top.get_shape().as_list(), "top_data_injection")
+        self.injection = tf.placeholder(self._top.dtype.base_dtype, self._top.get_shape().as_list(), "top_data_injection")
         l.set_embedding(self._top)
         l.set_inject_embedding(self.injection)
         #Create graph
@@ -520,23 +821,46 @@ class AutoEncoder(object):
         self.isDecoderValid = True
    
         
+    def export_layers(self):
+      """
+      Describes the encoder and the current decoder as a list of records holding numpy weights, in the order they are applied.
+      Each record is a dict with the layer's export() fields plus 'direction' ('encode' or 'decode') and 'weights' ([W, bias]).
+      Layers without an inference role, such as corruption, are left out.
+      """
+      records = []
+      for direction,layers in (('encode',self.encode_layers[1:]), ('decode',self.decode_layers[self._decode_start:])):
+        for l in layers:
+          record = l.export()
+          if record:
+            record['direction'] = direction
+            record['weights'] = self.s.run(l.weights())
+            records.append(record)
+      return records
+
     def build(self):
       with self.g.as_default():
-        #Build loss and optimization functions
+        #Build loss and optimization functions in float32 whatever the activation type
+        bottom = tf.cast(self.bottom_feed, tf.float32)
+        recon = tf.cast(self._recon, tf.float32)
         self._per_example_reconstruction_loss = tf.reduce_mean(
                                                               -cross_entropy(
-                                                                                  self.bottom_feed ,
-                                                                                  self._recon),
+                                                                                  bottom ,
+                                                                                  recon),
                                                               reduction_indices=range(
                                                                                       1,
                                                                                       self._recon.get_shape().ndims) 
                                                               )
         self._loss = tf.reduce_mean(
                                      tf.abs(
-                                             self.bottom_feed-
-                                             self._recon,
+                                             bottom-
+                                             recon,
                                              )
                                     )
+        #The loss without corruption or weight decay, so held out examples are scored deterministically
+        if any([isinstance(l, CorruptionLayer) for l in self.encode_layers]):
+          self._clean_loss = self.replica_loss(self.bottom_feed, lambda w: w, corrupt=False, regularize=False)
+        else:
+          self._clean_loss = self._loss
         
         #Sparsity
 #         if definition.sparsity_lr > 0.0:
@@ -571,6 +895,7 @@ class AutoEncoder(object):
         for layer in self.encode_layers:
           if not layer.freeze():
             trainableparameters+=layer.params()
+        self._trainable = [p for i,p in enumerate(trainableparameters) if p not in trainableparameters[:i]]
         implicitparameters=[]
         
         #Restore from checkpoint or Initialize new Variables
@@ -596,12 +921,43 @@ class AutoEncoder(object):
           
         # Optimization
         if len(trainableparameters) > 0:
-          self.optimizer = tf.train.MomentumOptimizer(self.LEARNING_RATE,self.MOMENTUM,use_locking=True)
-#           self.optimizer = tf.train.AdamOptimizer()
-          self.optimizer_objective = self.optimizer.minimize(self._loss, var_list=trainableparameters)
-          optimizer_slots = [x  for x in [self.optimizer.get_slot(v,n) for v in trainableparameters for n in self.optimizer.get_slot_names()] if x != None]
+          definition = self.encode_layers[-1].d
+          existingvariables = set(tf.all_variables())
+          self._global_step = tf.Variable(0, trainable=False, name="global_step")
+          if definition.lr is not None:
+            base_lr = definition.lr
+          else:
+            base_lr = DEFAULT_LEARNING_RATES.get(definition.optimizer, self.LEARNING_RATE)
+          if definition.momentum is not None:
+            momentum = definition.momentum
+          else:
+            momentum = self.MOMENTUM if definition.optimizer == 'momentum' else 0.0
+          self._learning_rate = learning_rate(definition, base_lr, self._global_step)
+          self.optimizer = make_optimizer(definition.optimizer, self._learning_rate, momentum)
+          if self.bottom_feed.dtype.base_dtype == tf.float16:
+            #Scale the loss so float16 gradients do not underflow, then unscale for the float32 master weights
+            gradients = self.optimizer.compute_gradients(self._loss*self.LOSS_SCALE, var_list=trainableparameters)
+            gradients = [(g/self.LOSS_SCALE, v) for g,v in gradients if g is not None]
+            self.optimizer_objective = self.optimizer.apply_gradients(gradients, global_step=self._global_step)
+          else:
+            self.optimizer_objective = self.optimizer.minimize(self._loss, global_step=self._global_step, var_list=trainableparameters)
+          #Slots and accumulators created by the optimizer, with the step counter
+          optimizer_slots = [v for v in tf.all_variables() if v not in existingvariables]
           implicitparameters += optimizer_slots
           uninitializedparameters += optimizer_slots
+          #Loss accumulation across steps without fetching
+          self._loss_sum = tf.Variable(0.0, trainable=False, name="loss_sum")
+          self._loss_count = tf.Variable(0.0, trainable=False, name="loss_count")
+          with tf.control_dependencies([self.optimizer_objective]):
+            self._accumulate_loss = tf.group(tf.assign_add(self._loss_sum, self._loss),
+                                             tf.assign_add(self._loss_count, 1.0))
+          self._reset_loss = tf.group(tf.assign(self._loss_sum, 0.0),
+                                      tf.assign(self._loss_count, 0.0))
+          implicitparameters += [self._loss_sum, self._loss_count]
+          uninitializedparameters += [self._loss_sum, self._loss_count]
+          #Chained training steps over the preloaded dataset are built on first use by train_steps
+          self._decayed = list(trainableparameters)
+          self._unrolled = {}
         if len(uninitializedparameters) > 0:
           tf.initialize_variables(uninitializedparameters).run(session=self.s)
         else:
@@ -610,6 +966,8 @@ class AutoEncoder(object):
         if self.summarize:
           tf.histogram_summary("representation_at_top"+str(self.layeruid), self._rep_ground_truth)
           tf.scalar_summary("reconstruction_loss"+str(self.layeruid),self._loss)
+          if len(trainableparameters) > 0:
+            tf.scalar_summary("learning_rate"+str(self.layeruid),self._learning_rate)
 #           if definition.sparsity_lr > 0.0:
 #             tf.histogram_summary("per_channel_mean_activation"+str(self.layeruid) , per_channel_mean_activation)
 #             tf.scalar_summary("sparsity_loss"+str(self.layeruid), definition.sparsity_lr*sparsity_loss)
@@ -622,41 +980,237 @@ class AutoEncoder(object):
           self. summaries = tf.merge_all_summaries()
   
     def top_shape(self):
-      return self.injection.get_shape().as_list()
+      """
+      Shape of the top for a minibatch of the data provider's batch size.
+      """
+      return [self.dp.shape()[0]]+self.injection.get_shape().as_list()[1:]
     
     def bottom_shape(self):
-      return self.bottom_feed.get_shape().as_list()
+      return [self.dp.shape()[0]]+self.bottom_feed.get_shape().as_list()[1:]
     
-    def fwd(self,data):
-      return self.s.run(self._top, feed_dict={self.bottom_feed:data})
+    def feed_dict(self, data=None, indices=None, features=None):
+      """
+      Builds the feed for a minibatch.
+      With a preloaded DataLayer the data may be omitted to use the batch at the on-graph cursor,
+      or replaced by indices into the preloaded dataset.
+      Features, if given, are fed in place of the frozen prefix's top so the prefix is not recomputed.
+      """
+      feed_dict = {}
+      if data is not None:
+        feed_dict[self.bottom_feed] = data
+      elif indices is not None:
+        feed_dict[self.encode_layers[0].indices] = indices
+      if features is not None:
+        feed_dict[self.prefix_top()] = features
+      return feed_dict
+
+    def prefix_top(self):
+      """
+      The top of the encoder layers below the newest one.
+      """
+      return self.encode_layers[-2].get_top()
+
+    def prefix_frozen(self):
+      """
+      True if every encoder layer below the newest one is frozen and at least one of them has weights.
+      """
+      prefix = self.encode_layers[:-1]
+      return all([l.freeze() for l in prefix]) and any([len(l.weights()) > 0 for l in prefix[1:]])
+
+    def prefix_weights(self):
+      """
+      Values of every weight in the encoder layers below the newest one.
+      """
+      return [w for l in self.encode_layers[1:-1] if l.weights() for w in self.s.run(l.weights())]
+
+    def fwd_prefix(self, data):
+      return self.s.run(self.prefix_top(), feed_dict={self.bottom_feed:data})
+
+    def fwd(self,data=None, indices=None):
+      return self.s.run(self._top, feed_dict=self.feed_dict(data, indices))
   
     def inject(self,data):
       return self.s.run(self._inject_recon, feed_dict={self.injection:data})
     
-    def fwd_back(self,data):
-          feed_dict = {self.bottom_feed:data}
-          _recon = self.s.run(self._recon,feed_dict=feed_dict)
+    def fwd_back(self,data=None, indices=None):
+          feed_dict = self.feed_dict(data, indices)
+          if data is None:
+            data,_recon = self.s.run([self.bottom_feed,self._recon],feed_dict=feed_dict)
+          else:
+            _recon = self.s.run(self._recon,feed_dict=feed_dict)
           return (data,_recon)    
        
-    def loss(self,data):
-        feed_dict = {self.bottom_feed:data}
+    def loss(self,data=None, indices=None, features=None):
+        feed_dict = self.feed_dict(data, indices, features)
         l = self.s.run(self._loss,feed_dict=feed_dict)
         return l
       
-    def per_example_reconstruction_loss(self,data):
-        feed_dict = {self.bottom_feed:data}
+    def clean_loss(self, data):
+        """
+        Returns the reconstruction loss of a minibatch without corruption or weight decay.
+        """
+        return self.s.run(self._clean_loss, feed_dict=self.feed_dict(data))
+
+    def per_example_reconstruction_loss(self,data=None, indices=None):
+        feed_dict = self.feed_dict(data, indices)
         l = self.s.run(self._per_example_reconstruction_loss,feed_dict=feed_dict)
         return l    
+
+    def fwd_back_loss(self, data=None, indices=None):
+        """
+        Returns the per example reconstruction loss, the top and the reconstruction of a minibatch from a single run.
+        """
+        feed_dict = self.feed_dict(data, indices)
+        return self.s.run([self._per_example_reconstruction_loss, self._top, self._recon], feed_dict=feed_dict)
+
+    def score_dataset(self, dp=None, filename=None):
+        """
+        Computes the per example reconstruction loss for every example of a data provider.
+        See score_columns.
+        """
+        return score_columns([self], dp or self.dp, filename)[:,0]
         
-    def train_mb(self,data): 
-          feed_dict = {self.bottom_feed:data}
-          if self.summarize:
-            summary_str,_,dummy, l = self.s.run([self.summaries, self._recon,self.optimizer_objective,self._loss],feed_dict=feed_dict)
-            self.writer.add_summary(summary_str,self.summaryid)
-            self.summaryid +=1
+    def train_mb(self,data=None, fetch_loss=True, indices=None, features=None):
+          """
+          Runs one optimization step on a minibatch.
+          Only the scalar loss is fetched, and summaries are written every SUMMARY_INTERVAL steps.
+          
+          @param: data The minibatch to train on.  
+                       With a preloaded DataLayer it may be omitted to train on the batch at the cursor and advance it.
+          @param: fetch_loss If False the loss is accumulated on the graph instead of returned.
+                             Retrieve the mean with accumulated_loss().
+          @param: indices Indices into the preloaded dataset to train on instead of data.
+          @param: features Cached outputs of the frozen prefix for this minibatch.  See prefix_top.
+          """
+          feed_dict = self.feed_dict(data, indices, features)
+          if fetch_loss:
+            fetches = [self.optimizer_objective,self._loss]
           else:
-            _,dummy, l = self.s.run([self._recon,self.optimizer_objective,self._loss],feed_dict=feed_dict)
-          return l
+            fetches = [self._accumulate_loss]
+          if len(feed_dict) == 0:
+            fetches.append(self.encode_layers[0].advance)
+          summarize = self.summarize and self.stepid % self.SUMMARY_INTERVAL == 0
+          if summarize:
+            fetches.append(self.summaries)
+          results = self.s.run(fetches,feed_dict=feed_dict)
+          if summarize:
+            self.writer.add_summary(results[-1],self.summaryid)
+            self.summaryid +=1
+          self.stepid += 1
+          if fetch_loss:
+            return results[1]
+
+    def replica_loss(self, bottom, read, corrupt=True, regularize=True):
+          """
+          Builds another copy of the current stage's encoder, decoder and loss on a given bottom.
+          The copy computes with the column's weights as returned by read, and creates no Variables.
+          
+          @param: bottom The batch to encode.
+          @param: read Maps each weight of the column to the tensor the copy uses for it.
+          @param: corrupt If False corruption layers are left out of the copy.
+          @param: regularize If False the weight decay is left out of the loss.
+          @return: The loss of the copy.
+          """
+          top = bottom
+          for l in self.encode_layers[1:]:
+            if not corrupt and isinstance(l, CorruptionLayer):
+              continue
+            r = l.d.instance(self.g, l.uid(), l.freeze())
+            r.set_constants([read(w) for w in l.weights()])
+            r.set_bottom(top)
+            r.build_fwd()
+            top = r.get_top()
+          recon = top
+          for l in self.decode_layers[self._decode_start:]:
+            r = l.d.instance(self.g, l.uid(), False)
+            r.set_constants([read(w) for w in l.weights()])
+            r.set_embedding(recon)
+            r.set_inject_embedding(recon)
+            r.build_back()
+            recon = r.get_recon()
+          loss = tf.reduce_mean(tf.abs(tf.cast(bottom, tf.float32) - tf.cast(recon, tf.float32)))
+          if regularize and self.ALPHA >0 and len(self._decayed) > 0:
+            weightsmagnitude = [tf.reduce_sum(tf.abs(read(w))) for w in self._decayed]
+            paramsize = reduce(add,[reduce(mul,w.get_shape().as_list()) for w in self._decayed ])
+            loss += self.ALPHA*reduce(add,weightsmagnitude)/paramsize
+          return loss
+
+    def build_steps(self, n):
+          """
+          Builds n optimization steps over on-graph batches of a preloaded DataLayer as one op.
+          
+          Each step draws its batch at the cursor, rebuilds the forward pass and loss with replica_loss,
+          applies the optimizer and advances the cursor.  Steps are chained with control dependencies,
+          and every step reads the weights and cursor afresh so it sees the update of the step before it.
+          The learning rate and the optimizer's own step dependent values, such as Adam's bias correction,
+          are evaluated once per run, so schedules advance n steps at a time.
+          
+          @return: (losses, done) where losses holds the loss of each step.  Run both to run the steps.
+          """
+          data = self.encode_layers[0]
+          losses = []
+          with self.g.as_default():
+            done = tf.no_op()
+            for i in xrange(n):
+              with tf.control_dependencies([done]):
+                reads = {}
+                def read(w):
+                  #Weights that are Variables are read after the previous step's update
+                  if not isinstance(w, tf.Variable):
+                    return w
+                  if w not in reads:
+                    reads[w] = tf.identity(w.ref())
+                  return reads[w]
+                cursor = tf.identity(data.cursor.ref())
+                _, bottom = data.batch_at(cursor)
+                loss = self.replica_loss(bottom, read)
+                variables = [v for v in self._trainable if v in reads]
+                if self.bottom_feed.dtype.base_dtype == tf.float16:
+                  gradients = tf.gradients(loss*self.LOSS_SCALE, [reads[v] for v in variables])
+                  gradients = [g/self.LOSS_SCALE if g is not None else None for g in gradients]
+                else:
+                  gradients = tf.gradients(loss, [reads[v] for v in variables])
+                step = self.optimizer.apply_gradients([(g,v) for g,v in zip(gradients, variables) if g is not None],
+                                                      global_step=self._global_step)
+              with tf.control_dependencies([step]):
+                done = data.advance_from(cursor)
+              losses.append(loss)
+            return (tf.pack(losses), done)
+
+    def train_steps(self, n):
+          """
+          Runs n optimization steps over on-graph batches from a preloaded DataLayer.
+          Up to UNROLL_STEPS steps are built into one op by build_steps and run, with their losses, in a single session.run.
+          
+          @param: n The number of steps to run.
+          @return: An array holding the loss of each step.
+          """
+          trace = [numpy.zeros(0, dtype=numpy.float32)]
+          while n > 0:
+            steps = min(n, self.UNROLL_STEPS)
+            if steps not in self._unrolled:
+              self._unrolled[steps] = self.build_steps(steps)
+            trace.append(self.s.run(self._unrolled[steps])[0])
+            self.stepid += steps
+            n -= steps
+          return numpy.concatenate(trace)
+
+    def snapshot(self):
+          """
+          Returns the values of the parameters the current stage trains, held in memory.  See restore_snapshot.
+          """
+          return self.s.run(self._trainable)
+
+    def restore_snapshot(self, values):
+          self.assign(self._trainable, values)
+
+    def accumulated_loss(self):
+          """
+          Returns the mean loss accumulated by train_mb(data, fetch_loss=False) since the last call, and resets it.
+          """
+          l, n = self.s.run([self._loss_sum, self._loss_count])
+          self.s.run(self._reset_loss)
+          return l/max(n,1.0)
 
 
           
@@ -1,19 +1,32 @@
-'''
+"""
+Spectral clustering baseline.
+
+The affinity is a sparse k nearest neighbour graph with self tuning bandwidths, built a chunk of rows at a time
+within MEMORY_BUDGET, so the baseline runs on the full dataset instead of a subsample.
+The leading eigenvectors of the normalized affinity are found with a sparse eigensolver,
+normalized per row and clustered with mini-batch k-means.
+The clusters are scored against the labels by evaluation.py.
+
+Usage:
+  python cluster.py <mnist images> <mnist labels>
+  python cluster.py <embedding .npy> <labels .npy>
+
 Created on Mar 17, 2016
 
 @author: jlovitt
-'''
+"""
 
 import numpy as np
 import sys
-from sklearn.cluster import DBSCAN,SpectralClustering
-from sklearn.preprocessing import StandardScaler
-from sklearn import metrics
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigsh
+from sklearn.cluster import MiniBatchKMeans
+from evaluation import evaluate, format_scores
 from dataio import MnistDataProvider
 
 class Object:
     pass
-  
+
 DATA_PARAM = Object()
 DATA_PARAM.batch_size = 6000
 
@@ -22,32 +35,98 @@ TRANSFORM_PARAM = Object()
 TRANSFORM_PARAM.mean_file = ""
 TRANSFORM_PARAM.mean_value = [127,127,127]
 TRANSFORM_PARAM.crop_size = 28
-TRANSFORM_PARAM.mirror = False  
+TRANSFORM_PARAM.mirror = False
+
+N_CLUSTERS = 10
+#Number of neighbours each example is connected to in the affinity graph
+N_NEIGHBORS = 10
+#The bandwidth of each example is its distance to this neighbour (Zelnik-Manor and Perona)
+SCALE_NEIGHBOR = 7
+#Bytes of distances held at once while building the graph
+MEMORY_BUDGET = 256*1024*1024
+KMEANS_BATCH_SIZE = 1000
+
 
+def knn(X, k, memory_budget=MEMORY_BUDGET):
+  """
+  Finds the k nearest neighbours of every row of X, excluding itself.
+
+  @param: X An array [n, d] of examples.
+  @param: memory_budget Bytes of the distance block computed at once.  Rows are processed in chunks that fit.
+  @return: (indices, distances), both [n, k], ordered by increasing distance.
+  """
+  X = X.astype(np.float32, copy=False)
+  n = len(X)
+  sq = np.sum(np.square(X), axis=1)
+  #The block and the partition of it are both held, in float32 and int64
+  chunk = max(1, int(memory_budget//(n*12)))
+  indices = np.empty([n, k], dtype=np.int64)
+  distances = np.empty([n, k], dtype=np.float32)
+  for i in range(0, n, chunk):
+    d = sq[i:i+chunk, np.newaxis] - 2*np.dot(X[i:i+chunk], X.T) + sq
+    rows = np.arange(len(d))
+    d[rows, i+rows] = np.inf
+    nearest = np.argpartition(d, k, axis=1)[:,:k]
+    nd = d[rows[:,np.newaxis], nearest]
+    order = np.argsort(nd, axis=1)
+    indices[i:i+chunk] = nearest[rows[:,np.newaxis], order]
+    distances[i:i+chunk] = np.sqrt(np.maximum(nd[rows[:,np.newaxis], order], 0))
+  return (indices, distances)
+
+def affinity(X, k=N_NEIGHBORS, scale_neighbor=SCALE_NEIGHBOR, memory_budget=MEMORY_BUDGET):
+  """
+  A symmetric sparse k nearest neighbour affinity with a self tuning Gaussian kernel,
+  A_ij = exp(-d_ij^2/(sigma_i*sigma_j)) with sigma_i the distance of example i to its scale_neighbor'th neighbour.
+
+  @return: A scipy.sparse.csr_matrix [n, n].
+  """
+  n = len(X)
+  indices, distances = knn(X, k, memory_budget)
+  sigma = np.maximum(distances[:, min(scale_neighbor, k)-1], 1e-8)
+  weights = np.exp(-np.square(distances)/(sigma[:,np.newaxis]*sigma[indices]))
+  A = sp.csr_matrix((weights.ravel(), indices.ravel(), np.arange(0, n*k+1, k)), shape=(n, n))
+  #Keep an edge if either end has the other among its neighbours
+  return A.maximum(A.T).tocsr()
+
+def spectral_embedding(A, n_components):
+  """
+  The leading eigenvectors of D^-1/2 A D^-1/2, with each row scaled to unit length (Ng, Jordan and Weiss).
+  """
+  d = np.asarray(A.sum(axis=1)).ravel()
+  d = 1.0/np.sqrt(np.maximum(d, 1e-12))
+  D = sp.diags(d)
+  L = D.dot(A).dot(D)
+  v0 = np.random.RandomState(0).rand(A.shape[0])
+  values, vectors = eigsh(L, k=n_components, which='LA', v0=v0)
+  vectors = vectors[:, np.argsort(values)[::-1]]
+  return vectors/np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def spectral_clustering(X, n_clusters=N_CLUSTERS, k=N_NEIGHBORS, memory_budget=MEMORY_BUDGET):
+  """
+  @param: X An array [n, ...] of examples, flattened to vectors.
+  @return: The cluster of each example.
+  """
+  X = X.reshape([len(X), -1])
+  print("Building {}-NN affinity of {} examples".format(k, len(X)))
+  A = affinity(X, k, memory_budget=memory_budget)
+  print("Affinity has {} edges".format(A.nnz))
+  embedding = spectral_embedding(A, n_clusters)
+  km = MiniBatchKMeans(n_clusters=n_clusters, batch_size=KMEANS_BATCH_SIZE, n_init=10, random_state=0)
+  return km.fit_predict(embedding)
 
 
 if __name__ == '__main__':
-  DATA_PARAM.source = sys.argv[1:]
-  dp = MnistDataProvider(DATA_PARAM,TRANSFORM_PARAM )
-  X,true_labels,keys = dp.get_mb().next()
-  X = X.reshape([DATA_PARAM.batch_size,-1])
-#     X = StandardScaler().fit_transform(X)
-#     print(X)
-#     print("scaled to range {}->{}".format(np.min(X),np.max(X)))
-#     db = DBSCAN(eps=0.1, min_samples = 10).fit(X)
-  cl = SpectralClustering(n_clusters=10).fit(X)
-  labels = cl.labels_
-
-  # Number of clusters in labels, ignoring noise if present.
-  n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-  
-  print("Accuracy {}".format(metrics.accuracy_score(true_labels,labels)))
-#   print('Estimated number of clusters: %d' % n_clusters_)
-#   print('Estimated number of clusters: %d' % n_clusters_)
-#   print("Homogeneity: %0.3f" % metrics.homogeneity_score(true_labels, labels))
-#   print("Completeness: %0.3f" % metrics.completeness_score(true_labels, labels))
-#   print("V-measure: %0.3f" % metrics.v_measure_score(true_labels, labels))
-#   print("Adjusted Rand Index: %0.3f"
-#         % metrics.adjusted_rand_score(true_labels, labels))
-#   print("Adjusted Mutual Information: %0.3f"
-#         % metrics.adjusted_mutual_info_score(true_labels, labels))
\ No newline at end of file
+  if len(sys.argv) < 3:
+    print(__doc__)
+    sys.exit(-1)
+  if sys.argv[1].endswith('.npy'):
+    X = np.load(sys.argv[1], mmap_mode='r')
+    true_labels = np.load(sys.argv[2])
+  else:
+    DATA_PARAM.source = sys.argv[1:]
+    dp = MnistDataProvider(DATA_PARAM,TRANSFORM_PARAM )
+    X = dp.get_dataset()[0]
+    true_labels = dp.get_labels()
+  labels = spectral_clustering(X)
+
+  print(format_scores(evaluate(true_labels,labels)))
@@ -34,6 +34,20 @@ DEFAULT_PATIENCE=15
 DEFAULT_PATIENCE_DELTA=0.0001
 
 
+# Hold the whole dataset in each column's graph and draw minibatches on-graph instead of feeding them.
+# Only for datasets that fit in memory (CIFAR, MNIST).
+PRELOAD_DATA = False
+
+# Build each greedy stage in a fresh graph with the frozen lower layers as constants,
+# so earlier decoders and optimizers do not accumulate in the columns' graphs.
+LAYERWISE_GRAPHS = False
+
+# Train stages whose lower layers are all frozen from cached outputs of those layers.
+# None disables the cache, otherwise the storage type: 'float32', 'float16' or 'uint8'.
+FEATURE_CACHE_DTYPE = None
+
+# Number of cached shards (minibatches) held decoded in memory
+FEATURE_CACHE_HOT_SHARDS = 64
 
 DATA_PARAM.batch_size = 64
 
@@ -41,11 +55,24 @@ TRANSFORM_PARAM.mean_file = ""
 TRANSFORM_PARAM.mean_value = [127,127,127]
 TRANSFORM_PARAM.crop_size = 31
 TRANSFORM_PARAM.mirror = False 
+# Type of the data and activations.  'float16' halves memory traffic; weights and losses stay float32.
+TRANSFORM_PARAM.dtype = 'float32'
+# ZCA whitening fit by zca.py, applied to every minibatch before cropping.  Empty to disable.
+TRANSFORM_PARAM.zca_file = ""
+# Further transforms applied in order to every minibatch before cropping, after any whitening.
+# e.g. [DifferenceOfGaussians(1, 0.5), Standardize()]
+from transforms import Whitening, DifferenceOfGaussians, Standardize
+TRANSFORM_PARAM.transforms = []
 
 
 """
 =======================  Layer Definitions ===========================
 """
+# Each stage is optimized as set by the keyword arguments of its Layerdef:
+#   optimizer: 'momentum' (default), 'adam' or 'rmsprop', with lr and momentum
+#   lr_schedule: None (constant), 'step', 'exponential' or 'cosine', with decay_steps and decay_rate
+#   warmup_steps: steps to ramp the learning rate up from zero
+# e.g. ConvLayerDef(5,2,8, optimizer='adam', lr=0.001, lr_schedule='cosine', decay_steps=20000, warmup_steps=500)
   
 
 # """
@@ -206,6 +233,12 @@ LAYERS = LAYERS_cifar
 """
 All Examples Pretraining -----------------------------------------------------
 """
+# Number of examples held out of pretraining to monitor for early stopping.
+# 0 trains on every example and monitors the training loss.  Set e.g. 1000 to opt in.
+N_VALIDATION_EXAMPLES = 0
+
+# Number of epochs between evaluations of the monitored loss
+EVAL_EVERY = 1
 
 
 """
@@ -213,6 +246,12 @@ Labeled example pretraining ----------------------------------------------------
 """
 N_LABELED_EXAMPLES = 8
 
+# Number of further examples of each label held out to monitor for early stopping.  0 monitors the training loss.
+N_LABELED_VALIDATION_EXAMPLES = 8
+
+# Number of training steps between evaluations of the monitored loss
+LABELED_EVAL_EVERY = 1
+
 """
 Clustering -----------------------------------------------------
 """
@@ -225,6 +264,25 @@ TRAIN_BATCHES = 20
 # Growth rate for TRAIN_BATCHES every training cycle
 D_TRAIN_BATCHES = 10
 
+# Report how well int8 quantized columns agree with float32 columns on routing after each clustered layer
+QUANTIZATION_REPORT = False
+
+# Render diagnostic images in a separate process instead of on the training thread
+VIS_PROCESS = True
+
+# Number of clustering rounds between diagnostic images
+VIS_INTERVAL = 1
+
+# Number of images that may wait to be rendered before new ones are dropped
+VIS_BACKLOG = 64
+
+# Draw diagnostic images from a sample of each column's examples kept during routing,
+# instead of running the columns again on mapped batches
+DIAGNOSTIC_RESERVOIR = True
+
+# Write the flattened tops of every example to memory mapped .npy files in the checkpoint directory after each layer
+SAVE_EMBEDDINGS = False
+
 
 
 """
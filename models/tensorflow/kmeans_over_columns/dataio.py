@@ -15,6 +15,7 @@ from google.protobuf import text_format
 import cPickle
 import gzip
 import weights_to_img as w2i
+from transforms import load_transform
 
 from caffe import *
 
@@ -42,12 +43,23 @@ class LMDBDataProvider:
             h_w = np.sqrt(np.shape(mean_narray)[0] / 3)
             self.mean_data = np.array(bp.data, dtype=np.float32).reshape([3, h_w, h_w])
         self.source = data_param.source
+        self.dtype = np.dtype(getattr(transform_param, 'dtype', 'float32'))
         self.batch_size = data_param.batch_size / mm_batch_num
         self.crop_size = transform_param.crop_size
         self.mirror = transform_param.mirror
+        self.holdout_keys = set()
+        self.transform = load_transform(transform_param)
+
+    def prepare(self, im):
+      '''
+      Applies the provider's transform to one normalized, uncropped c,y,x image.
+      '''
+      if self.transform is None:
+        return im
+      return self.transform.apply(im.transpose([1,2,0])[np.newaxis])[0].transpose([2,0,1]).astype(self.dtype, copy=False)
 
     def normalize(self,raw_image):
-      return (raw_image.astype(np.float32) - self.mean_data)/127.0
+      return ((raw_image.astype(np.float32) - self.mean_data)/127.0).astype(self.dtype, copy=False)
     
     def denormalize(self,normal_image):
       return (normal_image*127.0 +127).astype(np.uint8)
@@ -56,7 +68,7 @@ class LMDBDataProvider:
       env = lmdb.open(self.source, readonly=True)
       with env.begin(write=False, buffers=False) as txn:
             cursor = txn.cursor()
-            return len(cursor)
+            return len(cursor) - len(self.holdout_keys)
      
     def get_keys(self):
       env = lmdb.open(self.source, readonly=True)
@@ -65,15 +77,42 @@ class LMDBDataProvider:
             keys = []
             it = cursor.iternext(keys=True,values=False)
             for k in it:
-              keys.append(k)
+              if k not in self.holdout_keys:
+                keys.append(k)
       return keys
+
+    def get_labels(self):
+      '''
+      Returns the integer label of every example, in the order of get_keys().
+      Single valued labels are used as is and one-hot labels are converted to their index.
+      '''
+      env = lmdb.open(self.source, readonly=True)
+      labels = []
+      with env.begin(write=False, buffers=False) as txn:
+            cursor = txn.cursor()
+            for k,v in cursor:
+              if k in self.holdout_keys:
+                continue
+              d = Datum()
+              d.ParseFromString(v)
+              labels.append(d.label[0] if len(d.label) == 1 else np.argmax(d.label))
+      return np.asarray(labels, dtype=np.int64)
+
+    def split_holdout(self, n):
+      '''
+      Removes the last n examples from the provider and returns them as (data, labels, keys).
+      '''
+      keys = self.get_keys()[-n:]
+      holdout = self.get_mb_by_keys(keys)
+      self.holdout_keys.update(keys)
+      return holdout
   
     def shape(self):
         return (self.batch_size, self.crop_size, self.crop_size,3)
 
     def get_mb_by_keys(self,keys):
       env = lmdb.open(self.source, readonly=True)
-      samples = np.zeros([len(keys), self.crop_size ** 2 * 3], dtype=np.float32)
+      samples = np.zeros([len(keys), self.crop_size ** 2 * 3], dtype=self.dtype)
       num_label = -1      
       with env.begin(write=False, buffers=False) as txn:
         for i, key in zip(range(len(keys)), keys):
@@ -81,12 +120,12 @@ class LMDBDataProvider:
           d = Datum()
           d.ParseFromString(raw_dat) 
           ori_size = np.sqrt(len(d.data) / 3)
-          im = self.normalize(np.fromstring(d.data, dtype=np.uint8).reshape([3, ori_size, ori_size]))
+          im = self.prepare(self.normalize(np.fromstring(d.data, dtype=np.uint8).reshape([3, ori_size, ori_size])))
           [crop_h, crop_w] = np.random.randint(ori_size - self.crop_size, size=2)
           im_cropped = im[:, crop_h:crop_h+self.crop_size, crop_w:crop_w+self.crop_size]
           if self.mirror == True and numpy.random.rand() > 0.5:
             im_cropped = im_cropped[:,:,::-1] 
-          samples[i, :] = np.transpose(im_cropped,[1,2,0]).reshape(self.crop_size ** 2 * 3).astype(np.float32)
+          samples[i, :] = np.transpose(im_cropped,[1,2,0]).reshape(self.crop_size ** 2 * 3).astype(self.dtype, copy=False)
           
           '''
           #output
@@ -101,28 +140,31 @@ class LMDBDataProvider:
           
           if num_label == -1:
             num_label = len(d.label)
-            labels = np.zeros([self.batch_size, num_label], dtype=np.float32)
+            labels = np.zeros([len(keys), num_label], dtype=np.float32)
           labels[i, :] = d.label
       _shape = list(self.shape())
       _shape[0] = len(keys)
       return (np.reshape(samples, _shape), labels, keys)              
           
           
-    def get_mb(self, phase = 'TRAIN'):
+    def get_mb(self, phase = 'TRAIN', tail=False):
         ''' Get next minibatch
+        The final partial minibatch is only yielded when tail is True.
         '''
         env = lmdb.open(self.source, readonly=True)
-        samples = np.zeros([self.batch_size, self.crop_size ** 2 * 3], dtype=np.float32)
+        samples = np.zeros([self.batch_size, self.crop_size ** 2 * 3], dtype=self.dtype)
         keys = []
         num_label = -1
         count = 0
         with env.begin(write=False, buffers=False) as txn:
             cursor = txn.cursor()
             for key, value in cursor:
+                if key in self.holdout_keys:
+                    continue
                 d = Datum()
                 d.ParseFromString(value)
                 ori_size = np.sqrt(len(d.data) / 3)
-                im = self.normalize(np.fromstring(d.data, dtype=np.uint8).reshape([3, ori_size, ori_size]))
+                im = self.prepare(self.normalize(np.fromstring(d.data, dtype=np.uint8).reshape([3, ori_size, ori_size])))
                 if phase == 'TRAIN':
                     [crop_h, crop_w] = np.random.randint(ori_size - self.crop_size, size=2)
                 else:
@@ -133,7 +175,7 @@ class LMDBDataProvider:
                 if self.mirror == True and numpy.random.rand() > 0.5:
                     im_cropped = im_cropped[:,:,::-1]
                 
-                samples[count, :] = np.transpose(im_cropped,[1,2,0]).reshape(self.crop_size ** 2 * 3).astype(np.float32)
+                samples[count, :] = np.transpose(im_cropped,[1,2,0]).reshape(self.crop_size ** 2 * 3).astype(self.dtype, copy=False)
                 keys.append(key)
                
                 '''
@@ -162,8 +204,10 @@ class LMDBDataProvider:
                     
                     labels = np.zeros([self.batch_size, num_label], dtype=np.float32)
                     count = 0
-        if count != self.batch_size:
-          pass
+        if tail and count > 0:
+          _shape = list(self.shape())
+          _shape[0] = count
+          yield (np.reshape(samples[:count], _shape), labels[:count], keys)
 #             delete_idx = np.arange(count, self.batch_size)
 #             yield (np.delete(samples, delete_idx, 0), np.delete(labels, delete_idx, 0), keys)
 
@@ -177,7 +221,7 @@ class LMDBDataProvider:
         env = lmdb.open(self.source, readonly=True)
         view_num = 10
         ori_size = -1
-        samples = np.zeros([view_num, self.batch_size, self.crop_size ** 2 * 3], dtype=np.float32)
+        samples = np.zeros([view_num, self.batch_size, self.crop_size ** 2 * 3], dtype=self.dtype)
         num_label = -1
         count = 0
         with env.begin(write=False, buffers=False) as txn:
@@ -191,7 +235,7 @@ class LMDBDataProvider:
                     start_h = [0, diff_size, 0, diff_size, diff_size/2]
                     start_w = [0, 0, diff_size, diff_size, diff_size/2]
 
-                im = self.normalize(np.fromstring(d.data, dtype=np.uint8).reshape([3, ori_size, ori_size]))
+                im = self.prepare(self.normalize(np.fromstring(d.data, dtype=np.uint8).reshape([3, ori_size, ori_size])))
                 
                 for i in range(view_num):
                     crop_h = start_h[i/2]
@@ -199,7 +243,7 @@ class LMDBDataProvider:
                     im_cropped = im[:, crop_h:crop_h+self.crop_size, crop_w:crop_w+self.crop_size]
                     if i%2 == 1:
                         im_cropped = im_cropped[:,:,::-1]
-                    samples[i, count, :] = np.transpose(im_cropped,[1,2,0]).reshape(self.crop_size ** 2 * 3).astype(np.float32)
+                    samples[i, count, :] = np.transpose(im_cropped,[1,2,0]).reshape(self.crop_size ** 2 * 3).astype(self.dtype, copy=False)
                    
                 if num_label == -1:
                     num_label = len(d.label)
@@ -236,6 +280,7 @@ class CifarDataProvider:
         h_w = np.sqrt(np.shape(mean_narray)[0] / 3)
         self.mean_data = np.array(bp.data, dtype=np.float32).reshape([3, h_w, h_w])
     self.files = data_param.source
+    self.dtype = np.dtype(getattr(transform_param, 'dtype', 'float32'))
     self.batch_size = data_param.batch_size / mm_batch_num
     self.crop_size = transform_param.crop_size
     self.mirror = transform_param.mirror
@@ -244,6 +289,15 @@ class CifarDataProvider:
     self.data = self.normalize(self.data)
     self.data = self.data.reshape([-1,3,32,32])
     self.data = self.data.transpose([0,2,3,1])
+    self.transform = load_transform(transform_param)
+
+  def prepare(self, images):
+    '''
+    Applies the provider's transform to a batch of normalized, uncropped images.
+    '''
+    if self.transform is None:
+      return images
+    return self.transform.apply(images).astype(self.dtype, copy=False)
 
   def cache_data(self):
     self.data = None
@@ -263,26 +317,53 @@ class CifarDataProvider:
   def get_n_examples(self):
     return len(self.labels)
   
+  def split_holdout(self, n):
+    """
+    Removes the last n examples from the provider and returns them center cropped as (data, labels, keys).
+    """
+    d = (32 - self.crop_size)//2
+    holdout = (self.prepare(self.data[-n:])[:,d:d+self.crop_size,d:d+self.crop_size,:], self.labels[-n:], self.keys[-n:])
+    self.data = self.data[:-n]
+    self.labels = self.labels[:-n]
+    self.keys = self.keys[:-n]
+    return holdout
+  
+  def get_dataset(self):
+    """
+    Returns the whole normalized, uncropped dataset as (data, labels, keys).
+    """
+    if self.transform is None:
+      return (self.data, self.labels, self.keys)
+    data = np.concatenate([self.prepare(self.data[i:i+self.batch_size]) for i in range(0, len(self.data), self.batch_size)])
+    return (data, self.labels, self.keys)
+  
    
   def get_keys(self):
     return self.keys
 
+  def get_labels(self):
+    """
+    Returns the label of every example, in the order of get_keys().
+    """
+    return self.labels
+
   def shape(self):
       return (self.batch_size, self.crop_size, self.crop_size,3)
 
   def normalize(self,raw_image):
-    return (raw_image.astype(np.float32))/255.0
+    return ((raw_image.astype(np.float32))/255.0).astype(self.dtype, copy=False)
   
   def denormalize(self,normal_image):
     return (normal_image*255.0).astype(np.uint8)
 
   def get_mb_by_keys(self,keys):
-    samples = np.zeros([len(keys), self.crop_size,self.crop_size,3], dtype=np.float32)
+    samples = np.zeros([len(keys), self.crop_size,self.crop_size,3], dtype=self.dtype)
     labels = np.zeros([len(keys)],dtype=np.uint8)
     sorted_keys = sorted(keys)
-    for n,key in enumerate(sorted_keys):
-      i = self.keys.index(key)
-      mb = self.data[i,:,:,:]
+    indices = [self.keys.index(key) for key in sorted_keys]
+    images = self.prepare(self.data[indices])
+    for n,i in enumerate(indices):
+      mb = images[n,:,:,:]
 #       mb_4 = mb.reshape([1,3,32,32])
 #       mb_n = self.normalize(mb_4)
 #       mb_t = mb_4.transpose([0,2,3,1])
@@ -292,12 +373,13 @@ class CifarDataProvider:
     return (samples,labels,keys)
     
 
-  def get_mb(self):
-    samples = np.zeros([self.batch_size, self.crop_size,self.crop_size,3], dtype=np.float32)
+  def get_mb(self, tail=False):
+    samples = np.zeros([self.batch_size, self.crop_size,self.crop_size,3], dtype=self.dtype)
     lbls = np.zeros([self.batch_size])
     i = 0
-    while i < (self.get_n_examples() - self.batch_size):
-      mb = self.data[i:i+self.batch_size,:]
+    end = self.get_n_examples() if tail else self.get_n_examples() - self.batch_size
+    while i < end:
+      mb = self.prepare(self.data[i:i+self.batch_size,:])
 #       mb_4 = mb.reshape([self.batch_size,3,32,32])
 #       mb_n = self.normalize(mb_4)
 #       mb_t = mb_4.transpose([0,2,3,1])
@@ -315,11 +397,22 @@ class MnistDataProvider:
   
   def __init__(self, data_param, transform_param, mm_batch_num=1):
     self.files = data_param.source
+    self.dtype = np.dtype(getattr(transform_param, 'dtype', 'float32'))
     self.batch_size = data_param.batch_size / mm_batch_num
     self.crop_size = transform_param.crop_size
     self.mirror = transform_param.mirror
+    self.n_examples = 60000
     self._data = self.extract_data(self.files[0],self.get_n_examples())
     self._labels = self.extract_labels(self.files[1], self.get_n_examples())
+    self.transform = load_transform(transform_param)
+
+  def prepare(self, images):
+    '''
+    Applies the provider's transform to a batch of normalized, uncropped images.
+    '''
+    if self.transform is None:
+      return images
+    return self.transform.apply(images).astype(self.dtype, copy=False)
   
   
   def extract_data(self,filename, num_images):
@@ -349,43 +442,72 @@ class MnistDataProvider:
     return labels
   
   def get_n_examples(self):
-    return 60000
+    return self.n_examples
+  
+  def split_holdout(self, n):
+    """
+    Removes the last n examples from the provider and returns them center cropped as (data, labels, keys).
+    """
+    d = (28 - self.crop_size)//2
+    self.n_examples -= n
+    keys = range(self.n_examples, self.n_examples+n)
+    holdout = (self.prepare(self._data[-n:])[:,d:d+self.crop_size,d:d+self.crop_size,:], self._labels[-n:], keys)
+    self._data = self._data[:-n]
+    self._labels = self._labels[:-n]
+    return holdout
+  
+  def get_dataset(self):
+    """
+    Returns the whole normalized, uncropped dataset as (data, labels, keys).
+    """
+    if self.transform is None:
+      return (self._data, self._labels, self.get_keys())
+    data = np.concatenate([self.prepare(self._data[i:i+self.batch_size]) for i in range(0, len(self._data), self.batch_size)])
+    return (data, self._labels, self.get_keys())
    
   def get_keys(self):
     return range(self.get_n_examples())
 
+  def get_labels(self):
+    """
+    Returns the label of every example, in the order of get_keys().
+    """
+    return self._labels
+
   def shape(self):
       return (self.batch_size,  self.crop_size, self.crop_size,1)
 
   def normalize(self,raw_image):
-    return (raw_image.astype(np.float32))/255.0
+    return ((raw_image.astype(np.float32))/255.0).astype(self.dtype, copy=False)
   
   def denormalize(self,normal_image):
     return (normal_image*255.0).astype(np.uint8)
 
   def get_mb_by_keys(self,keys):
-    samples = np.zeros([len(keys)] +[ self.crop_size,self.crop_size,1], dtype=np.float32)
+    samples = np.zeros([len(keys)] +[ self.crop_size,self.crop_size,1], dtype=self.dtype)
     labels = np.zeros([len(keys)],dtype=np.uint8)
     sorted_keys = sorted(keys)
-    for n,key in enumerate(sorted_keys):
-      i = int(key)
+    indices = [int(key) for key in sorted_keys]
+    images = self.prepare(self._data[indices])
+    for n,i in enumerate(indices):
       dx,dy = np.random.randint(28 - self.crop_size+1, size=2)
-      samples[n,:,:,:] = self._data[i,dx:dx+self.crop_size,dy:dy+self.crop_size,:]
+      samples[n,:,:,:] = images[n,dx:dx+self.crop_size,dy:dy+self.crop_size,:]
 #       samples[n,:,:,:] = self._data[i,:,:,:]
       labels[n] = self._labels[i]
     return (samples,labels,keys)
     
 
-  def get_mb(self):
-    samples = np.zeros(self.shape(), dtype=np.float32)
+  def get_mb(self, tail=False):
+    samples = np.zeros(self.shape(), dtype=self.dtype)
     labels = np.zeros([self.batch_size])
     i = 0
-    while i < (self.get_n_examples() - self.batch_size):
+    end = self.get_n_examples() if tail else self.get_n_examples() - self.batch_size
+    while i < end:
       dx,dy = np.random.randint(28 - self.crop_size+1, size=2)
-      samples = self._data[i:i+self.batch_size,dx:dx+self.crop_size,dy:dy+self.crop_size,:]
+      samples = self.prepare(self._data[i:i+self.batch_size])[:,dx:dx+self.crop_size,dy:dy+self.crop_size,:]
 #       samples[:,:,:,:] = self._data[i:i+self.batch_size,:,:,:]
       labels = self._labels[i:i+self.batch_size]
-      keys = range(i,i+self.batch_size)
+      keys = range(i,min(i+self.batch_size,self.get_n_examples()))
       yield (samples,labels,keys)
       i += self.batch_size  
   
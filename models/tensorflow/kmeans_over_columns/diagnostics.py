@@ -0,0 +1,109 @@
+"""
+Per column statistics gathered during the routing pass.
+
+Each class is an observer for score_columns.  Every minibatch is routed to the column with the least
+reconstruction loss and the observer keeps what it needs from the run that scored it,
+so diagnostics need no further passes over the data or the columns.
+"""
+
+import numpy as np
+
+
+class RoutingReservoir(object):
+  """
+  A uniform random sample of the examples routed to each column, with their tops and reconstructions.
+  """
+  outputs = True
+
+  def __init__(self, n_columns, capacity):
+    """
+    @param: n_columns The number of columns being routed to.
+    @param: capacity The number of examples kept per column.
+    """
+    self.capacity = capacity
+    self.seen = [0]*n_columns
+    self.filled = [0]*n_columns
+    self.data = [None]*n_columns
+    self.tops = [None]*n_columns
+    self.recons = [None]*n_columns
+    self.keys = [[None]*capacity for c in range(n_columns)]
+
+  def update(self, data, keys, scores, tops, recons):
+    routes = np.argmin(scores, axis=1)
+    for c in range(len(self.seen)):
+      routed = np.flatnonzero(routes == c)
+      if len(routed) == 0:
+        continue
+      if self.data[c] is None:
+        self.data[c] = np.empty([self.capacity]+list(data.shape[1:]), dtype=data.dtype)
+        self.tops[c] = np.empty([self.capacity]+list(tops[c].shape[1:]), dtype=tops[c].dtype)
+        self.recons[c] = np.empty([self.capacity]+list(recons[c].shape[1:]), dtype=recons[c].dtype)
+      #Reservoir sampling: the t'th example routed to a column replaces a random slot with probability capacity/(t+1)
+      t = self.seen[c] + np.arange(len(routed))
+      slots = np.where(t < self.capacity, t, (np.random.rand(len(routed))*(t+1)).astype(np.int64))
+      keep = slots < self.capacity
+      routed = routed[keep]
+      slots = slots[keep]
+      self.data[c][slots] = data[routed]
+      self.tops[c][slots] = tops[c][routed]
+      self.recons[c][slots] = recons[c][routed]
+      for slot,i in zip(slots, routed):
+        self.keys[c][slot] = keys[i]
+      self.seen[c] += len(t)
+      self.filled[c] = min(self.seen[c], self.capacity)
+
+  def sample(self, column):
+    """
+    @return: (data, tops, recons, keys) of the examples kept for a column.  Empty if none were routed to it.
+    """
+    n = self.filled[column]
+    if n == 0:
+      return (np.zeros(0), np.zeros(0), np.zeros(0), [])
+    return (self.data[column][:n], self.tops[column][:n], self.recons[column][:n], self.keys[column][:n])
+
+
+class ColumnMoments(object):
+  """
+  Streaming per pixel mean and variance of the examples routed to each column.
+  Minibatches are merged with the parallel form of Welford's algorithm, so memory is bounded by one image per column.
+  """
+  outputs = False
+
+  def __init__(self, n_columns, shape):
+    """
+    @param: n_columns The number of columns being routed to.
+    @param: shape The shape of one example.
+    """
+    self.count = np.zeros(n_columns, dtype=np.int64)
+    self._mean = np.zeros([n_columns]+list(shape), dtype=np.float64)
+    self._m2 = np.zeros([n_columns]+list(shape), dtype=np.float64)
+
+  def add(self, column, x):
+    """
+    Merges a chunk of examples into a column's moments.
+    """
+    n = len(x)
+    if n == 0:
+      return
+    x = x.astype(np.float64)
+    mean = np.mean(x, axis=0)
+    m2 = np.sum(np.square(x-mean), axis=0)
+    total = self.count[column] + n
+    delta = mean - self._mean[column]
+    self._mean[column] += delta*(float(n)/total)
+    self._m2[column] += m2 + np.square(delta)*(float(self.count[column])*n/total)
+    self.count[column] = total
+
+  def update(self, data, keys, scores, tops, recons):
+    routes = np.argmin(scores, axis=1)
+    for c in range(len(self.count)):
+      self.add(c, data[routes == c])
+
+  def mean(self):
+    return self._mean
+
+  def variance(self):
+    """
+    The population variance of each column.  Zero for columns without examples.
+    """
+    return self._m2/np.maximum(self.count, 1).reshape([-1]+[1]*(self._m2.ndim-1))
@@ -1,31 +1,76 @@
-'''
+"""
+Difference of Gaussians preprocessing of a whole dataset.
+
+The dataset is filtered a chunk at a time with the separable blurs of transforms.py, across a pool of processes.
+A first pass finds the range of the filtered values and a second pass scales them to uint8
+and writes them to the output as each chunk completes, so memory is bounded by the chunks in flight.
+
 Created on May 5, 2016
 
 @author: jlovitt
-'''
+"""
 
 import numpy as np
 import sys
 import cPickle
-from sklearn.decomposition import PCA
+import multiprocessing
 import weights_to_img as w2i
 import matplotlib.pyplot as plt
-from scipy.ndimage.filters import gaussian_filter
-
-  
-def dog(imgs, sigma1, sigma2):
-  imgsf32 = imgs.astype(np.float32)
-  a = gaussian_filter(imgsf32, [0,0,sigma1, sigma1])
-  b = gaussian_filter(imgsf32, [0,0,sigma2, sigma2])
-  print("MIN {}, MAX {}".format(np.min(imgs), np.max(imgs)))
-  print(a.dtype)
-  dog = a-b
-  m =np.min(dog)
-  M = np.max(dog)
-  r = M-m
-  dog = (dog-m)/r*255.0
-  dogi8 = dog.astype(np.uint8)
-  return a,b,dogi8
+from transforms import blur, difference_of_gaussians
+
+CHUNK = 1000
+
+
+def dog_chunk(imgs, sigma1, sigma2):
+  """
+  @param: imgs A chunk of n,c,y,x images.
+  @return: The float32 difference of Gaussians of the chunk, n,c,y,x.
+  """
+  nhwc = np.transpose(imgs, [0,2,3,1]).astype(np.float32)
+  return np.transpose(difference_of_gaussians(nhwc, sigma1, sigma2), [0,3,1,2])
+
+def _chunk_range(args):
+  d = dog_chunk(*args)
+  return (np.min(d), np.max(d))
+
+def _chunk_uint8(args):
+  imgs, sigma1, sigma2, m, r = args
+  d = (dog_chunk(imgs, sigma1, sigma2) - m)/r*255.0
+  return d.astype(np.uint8)
+
+def _chunks(imgs, sigma1, sigma2, chunk, *extra):
+  for i in range(0, len(imgs), chunk):
+    yield (imgs[i:i+chunk], sigma1, sigma2) + extra
+
+def dog_range(imgs, sigma1, sigma2, chunk=CHUNK, pool=None):
+  """
+  First pass.  Streams the dataset through the filter and keeps only the extremes.
+  @return: (min, max) of the difference of Gaussians over the dataset.
+  """
+  mapper = map if pool is None else pool.imap
+  ranges = list(mapper(_chunk_range, _chunks(imgs, sigma1, sigma2, chunk)))
+  return (min(r[0] for r in ranges), max(r[1] for r in ranges))
+
+def dog(imgs, sigma1, sigma2, out=None, chunk=CHUNK, pool=None):
+  """
+  Filters a dataset into uint8 images scaled by the global range of the difference of Gaussians.
+
+  @param: imgs An array, or memory map, of n,c,y,x images.
+  @param: out Array or memory map of the same shape receiving the uint8 output.  Allocated if None.
+  @param: chunk Number of images filtered at a time by each process.
+  @param: pool A multiprocessing.Pool to filter chunks in parallel, or None to filter in this process.
+  @return: out
+  """
+  if out is None:
+    out = np.empty(imgs.shape, dtype=np.uint8)
+  m,M = dog_range(imgs, sigma1, sigma2, chunk, pool)
+  print("DoG range [{}, {}]".format(m, M))
+  r = max(M-m, 1e-8)
+  mapper = map if pool is None else pool.imap
+  #imap yields in order, so each chunk is written as soon as it and its predecessors are done
+  for i,d in zip(range(0, len(imgs), chunk), mapper(_chunk_uint8, _chunks(imgs, sigma1, sigma2, chunk, m, r))):
+    out[i:i+len(d)] = d
+  return out
 
 
 if __name__ == '__main__':
@@ -36,15 +81,22 @@ if __name__ == '__main__':
     data = np.reshape(data,[len(data), 3,32,32])
     original_shape = data.shape
     print("Original Data Shape {}".format(original_shape))
-    a,b,dog_data = dog(data,1,0.5)
+    pool = multiprocessing.Pool()
+    dog_data = np.lib.format.open_memmap("dog_cifar_data.npy", mode='w+', dtype=np.uint8, shape=data.shape)
+    dog(data, 1, 0.5, out=dog_data, pool=pool)
+    pool.close()
+    dog_data.flush()
     print("Dog Data Shape {}".format(dog_data.shape))
+    sample = np.transpose(data[0:2], [0,2,3,1]).astype(np.float32)
+    a = np.transpose(blur(sample, 1), [0,3,1,2])
+    b = np.transpose(blur(sample, 0.5), [0,3,1,2])
     appended_mat = np.append(
-                             np.append(data[0:2], 
-                                       a[0:2],
+                             np.append(data[0:2],
+                                       a,
                                        axis=0
                                        ),
-                             np.append(b[0:2],
-                                       dog_data[0:2], 
+                             np.append(b,
+                                       dog_data[0:2],
                                        axis =0
                                        ),
                              axis=0
@@ -54,8 +106,8 @@ if __name__ == '__main__':
     comp = w2i.tile_imgs(comparison_mat)
     plt.imshow(comp)
     plt.show()
-    newdatadict = {'data':dog_data,
+    newdatadict = {'data':np.asarray(dog_data),
                    'labels':datadict['labels']}
     with open("dog_cifar_data", 'w') as fo:
       cPickle.dump(newdatadict, fo)
-    
\ No newline at end of file
+
@@ -16,8 +16,14 @@ from itertools import islice, cycle
 from PIL import Image
 import math
 import weights_to_img as w2i
+from quantize import routing_report
 from os import path
-from column_definition import LAYERS,DATA_PARAM,TRANSFORM_PARAM,NUM_LABELS,get_dp, N_COLUMNS, TRAIN_BATCHES, D_TRAIN_BATCHES
+from column_definition import LAYERS,DATA_PARAM,TRANSFORM_PARAM,NUM_LABELS,get_dp, N_COLUMNS, TRAIN_BATCHES, D_TRAIN_BATCHES, LAYERWISE_GRAPHS, QUANTIZATION_REPORT, VIS_PROCESS, VIS_INTERVAL, VIS_BACKLOG, DIAGNOSTIC_RESERVOIR, SAVE_EMBEDDINGS
+from planner import plan_layers, format_plan
+from visualizer import Renderer, VisualizationWorker
+from diagnostics import RoutingReservoir, ColumnMoments
+from evaluation import evaluate, format_scores
+from util import save_embeddings
 
 
 
@@ -48,28 +54,33 @@ def stationary(a,b,thresh):
     return True,r
   return False,r
 
-def map_img_2_col(columns):
+def map_img_2_col(columns, diagnose=False):
   """
   Computes a mapping from image to column where each image is mapped to the column that encodes it with the least error.
+  The mean and variance of the examples mapped to each column are kept from the same pass under 'moments'.
   
   @param: columns The columns to obtain error from.
+  @param: diagnose If True a reservoir of the examples mapped to each column, with their tops and reconstructions,
+                   is also kept from the same pass under 'reservoir'.
   """
   key2col = {}
   col2keys = dict([(col,[]) for col in columns.keys()])
   col2key_count = dict([(col,0) for col in columns.keys()])
-  outputs = np.zeros([DATA_PARAM.batch_size, len(columns)])
-  for mb in dp.get_mb():
-    for i,column in columns.iteritems():
-       tmp = column.per_example_reconstruction_loss(mb[0])
-       outputs[:,i] = tmp
-      #outputs[:,i] = np.mean(np.max(np.max(act, axis=1), axis=1), axis=1)
-    maxvals = np.argmin(outputs,axis=1)
-    for key,col in zip(mb[2],maxvals):
-      key2col[key] = col
-      col2key_count[col] += 1
-      col2keys[col].append(key)
+  observers = []
+  reservoir = None
+  moments = ColumnMoments(len(columns), dp.shape()[1:])
+  observers.append(moments)
+  if diagnose:
+    reservoir = RoutingReservoir(len(columns), dp.shape()[0])
+    observers.append(reservoir)
+  outputs = score_columns([columns[i] for i in range(len(columns))], dp, observers=observers)
+  maxvals = np.argmin(outputs,axis=1)
+  for key,col in zip(dp.get_keys(),maxvals):
+    key2col[key] = col
+    col2key_count[col] += 1
+    col2keys[col].append(key)
   #print "Mapping Stats: ",stats
-  return {'key2col':key2col, 'n_examples':col2key_count, "col2key":col2keys}
+  return {'key2col':key2col, 'n_examples':col2key_count, "col2key":col2keys, 'routes':maxvals, 'reservoir':reservoir, 'moments':moments}
 
  
 def train(imap, columns, keys, batches):
@@ -97,13 +108,13 @@ def train(imap, columns, keys, batches):
 #     n_updates = max_examples/DATA_PARAM.batch_size
     for b in range(batches):
 #         print "Training Batch: {}".format(b)
-        losses = dict([(col,0) for col in columns.keys()])
         for colnum,col in columns.iteritems():
           batch_keys = list(islice(cycle(imap['col2key'][colnum]),per_column_batch_key_index[colnum],per_column_batch_key_index[colnum]+DATA_PARAM.batch_size))
           per_column_batch_key_index[colnum] += DATA_PARAM.batch_size
           s,l,k = dp.get_mb_by_keys(batch_keys)
           #print("\tTraining column {} on {} keys".format(colnum,len(batch_keys)))
-          losses[colnum] += columns[colnum].train_mb(s)
+          columns[colnum].train_mb(s, fetch_loss=False)
+    losses = dict([(colnum,col.accumulated_loss()) for colnum,col in columns.iteritems()])
     return losses            
 
 def get_mapped_batch(dp, column_num, immap):
@@ -116,19 +127,23 @@ def get_mapped_batch(dp, column_num, immap):
     else:
       return np.zeros(0),np.zeros(0),[]
     
-def save_recon(dp, columns, immap):
+def save_recon(dp, columns, immap, viz):
     for n,column in columns.iteritems():
       #Reconstruct mapped examples
-      mapped_samples,_,_ = get_mapped_batch(dp, n, immap)
-      if len(mapped_samples) == dp.shape()[0]:
-        d,r = column.fwd_back(mapped_samples)
+      if immap.get('reservoir'):
+        d,_,r,_ = immap['reservoir'].sample(n)
+      else:
+        d = r = np.zeros(0)
+        mapped_samples,_,_ = get_mapped_batch(dp, n, immap)
+        if len(mapped_samples) == dp.shape()[0]:
+          d,r = column.fwd_back(mapped_samples)
+      if len(d) > 0:
         s = list(d.shape)
         s[0] = s[0]*2
         d_r_array = np.empty(s,dtype=d.dtype)
         d_r_array[0::2,:,:,:] = d
         d_r_array[1::2,:,:,:] = r
-        im = w2i.tile_imgs(d_r_array)
-        im.save(IMG_DIR+'col'+str(n)+'_mapped_recon_level'+str(layer_number+1)+'.png')
+        viz.submit(d_r_array, IMG_DIR+'col'+str(n)+'_mapped_recon_level'+str(layer_number+1)+'.png')
         
 def save_injection(dp,columns,immap):
     for n,column in columns.iteritems():
@@ -149,32 +164,35 @@ def save_injection(dp,columns,immap):
 #       im = Image.fromarray(dp.denormalize(c[0,:]).astype(np.uint8).squeeze(),mode='L')
       im.save(IMG_DIR+'col'+str(n)+'_level'+str(layer_number+1)+'_decode.png')    
 
-def save_top(dp, columns,immap):
+def save_top(dp, columns,immap,viz):
     for n,column in columns.iteritems():
-      mapped_samples,_,_ = get_mapped_batch(dp, n, immap)
-      if len(mapped_samples) == 0:
-        return
-      mapped_batch = np.zeros(dp.shape())
-      mapped_batch[0:len(mapped_samples),:] = mapped_samples
-      t = column.fwd(mapped_batch)
+      if immap.get('reservoir'):
+        _,t,_,_ = immap['reservoir'].sample(n)
+      else:
+        mapped_samples,_,_ = get_mapped_batch(dp, n, immap)
+        if len(mapped_samples) == 0:
+          return
+        t = column.fwd(mapped_samples)
+      if len(t) == 0:
+        continue
       top_shape = column.top_shape()
       if len(top_shape) == 4:
-        im = w2i.tile_imgs(t)
   #       im = Image.fromarray(dp.denormalize(c[0,:]).astype(np.uint8).squeeze(),mode='L')
-        im.save(IMG_DIR+'col'+str(n)+'_level'+str(layer_number+1)+'_top.png')  
+        viz.submit(t, IMG_DIR+'col'+str(n)+'_level'+str(layer_number+1)+'_top.png')
       elif len(top_shape) == 2:
-        t = t.reshape([1]+top_shape+[1])
-        im = w2i.tile_imgs(t)
-        im.save(IMG_DIR+'col'+str(n)+'_level'+str(layer_number+1)+'_top.png')  
+        t = t.reshape([1]+list(t.shape)+[1])
+        viz.submit(t, IMG_DIR+'col'+str(n)+'_level'+str(layer_number+1)+'_top.png')
       else:  
         print("Top not saved.  Dimenstions {}".format(top_shape)) 
 
-def save_exemplars(dp, columns,immap):
+def save_exemplars(dp, columns,immap,viz):
       for i in range(len(columns)):
-        sample,l,k = get_mapped_batch(dp, i, immap)
+        if immap.get('reservoir'):
+          sample,_,_,k = immap['reservoir'].sample(i)
+        else:
+          sample,l,k = get_mapped_batch(dp, i, immap)
         if k != None and len(k) > 0:  
-          im = w2i.tile_imgs(sample)
-          im.save(IMG_DIR+"col"+str(i)+"_exemplars.png")
+          viz.submit(sample, IMG_DIR+"col"+str(i)+"_exemplars.png")
         #display(dp.denormalize(s.run(columns[i].layers[-1].W).transpose([3,0,1,2])))
 
  
@@ -189,39 +207,23 @@ def mapping_stats(mapping):
 
 def pretrain_epoch(columns,dp, i):
     print("Pretrain epoch {}".format(i))
-    losses = dict([(col,0) for col in columns.keys()])
-    n = 0
     for mb in dp.get_mb():
-      n += 1
       for colnum,column in columns.iteritems():
-        losses[colnum] += column.train_mb(mb[0])
-    losses = dict([(col,v/n) for col,v in losses.iteritems()])
+        column.train_mb(mb[0], fetch_loss=False)
+    losses = dict([(col,column.accumulated_loss()) for col,column in columns.iteritems()])
     return losses
   
   
-def save_embedding(column,dp):
-  print("Saving embedding")
-  effective_examples = dp.get_n_examples() - dp.get_n_examples()%dp.shape()[0]
-  embedding = np.zeros((effective_examples,column.top_shape()[-1]))
-  labels = np.zeros((effective_examples), dtype = np.uint32)
-  i = 0
-  mb_size = dp.shape()[0]
-  for mb in dp.get_mb():
-    embedding[i:i+mb_size,:] = column.fwd(mb[0])
-    labels[i:i+mb_size] = mb[1]
-  np.save(path.join(CHECKPOINT_DIR,"embedding"), embedding)
-  np.save(path.join(CHECKPOINT_DIR,"embedding_labels"), labels)
+def save_embedding(dp,columns,layer_number):
+  #Embed the dataset with every column in one pass
+  save_embeddings([columns[i] for i in range(len(columns))], dp, CHECKPOINT_DIR, "embedding_level"+str(layer_number))
    
    
-def save_column_means(dp,columns,immap):
-  #generate mean image for each column
-  means = np.zeros([N_COLUMNS]+list(dp.shape()[1:]))
-  for i,(col,keys) in enumerate(immap['col2key'].iteritems()):
-    mb = dp.get_mb_by_keys(keys)
-    x = np.mean(mb[0],axis=0)
-    means[i,:,:,:]  = x
-  im = w2i.tile_imgs(means)
-  im.save(IMG_DIR+"mean_imgs.png")
+def save_column_means(dp,columns,immap,viz):
+  #generate mean and variance images for each column, from the moments kept while routing
+  moments = immap['moments']
+  viz.submit(moments.mean(), IMG_DIR+"mean_imgs.png")
+  viz.submit(moments.variance(), IMG_DIR+"variance_imgs.png")
 
 def print_column_entropy(dp,columns,immap):
   #Get column entropy
@@ -266,24 +268,12 @@ def print_class_entropy(dp,columns,immap):
     output += "Entropy: {}\n".format(entropy)
   return output  
 
-#TODO: This is not correct !!!
-def accuracy(dp,columns,immap): 
-  #print accuracy
-  #Determined by assuming each column represents it's majority class.
-  #Each non-majority class assigned to it will be an error.
-  #Get class assignment entropy
-  anchor_assignments = {col:[0]*NUM_LABELS for key,col in immap['key2col'].iteritems()}
-  class_assignments = {}
-  for key,col in immap['key2col'].iteritems():
-    _,l,_ = dp.get_mb_by_keys([key])
-    if l[0] not in class_assignments:
-      class_assignments[l[0]] = [0]*len(columns.keys())
-    anchor_assignments[col][l[0]] += 1
-    class_assignments[l[0]][col] += 1 
-  errors = 0
-  for col in anchor_assignments:
-    errors += reduce(add,anchor_assignments[col]) - max(anchor_assignments[col])
-  return 1.0 - float(errors)/dp.get_n_examples()
+def accuracy(dp,columns,immap):
+  """
+  Scores the mapping of examples to columns against the true labels.
+  @return: A dictionary of the matched accuracy, NMI, ARI and purity, see evaluation.evaluate.
+  """
+  return evaluate(dp.get_labels(), immap['routes'])
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
@@ -296,13 +286,19 @@ if __name__ == '__main__':
     IMG_DIR =  path.join(BASE_PATH,'img/')
     CHECKPOINT_DIR =  path.join(BASE_PATH,'check/')
     dp = get_dp(DATA_PARAM,TRANSFORM_PARAM )
+    print(format_plan(plan_layers(LAYERS, dp.shape()[1:], dp.shape()[0], dp.dtype.itemsize), N_COLUMNS))
     imgkeys = dp.get_keys()
     columns = {}
+    #Started before any session so the render process is not forked from TensorFlow
+    if VIS_PROCESS:
+      viz = VisualizationWorker(VIS_INTERVAL, VIS_BACKLOG)
+    else:
+      viz = Renderer(VIS_INTERVAL)
     with tf.Session() as sess:
       for i in range(N_COLUMNS):
         g = tf.Graph()
         s = tf.Session(graph=g)
-        columns[i] = AutoEncoder(s,g,dp,LOG_DIR, CHECKPOINT_DIR, colnum=i)
+        columns[i] = AutoEncoder(s,g,dp,LOG_DIR, CHECKPOINT_DIR, colnum=i, layerwise=LAYERWISE_GRAPHS)
       print "Columns Initialized"
       
       #Helper Function
@@ -318,6 +314,7 @@ if __name__ == '__main__':
           column.add_layer(l['Layerdef'], l.get('Mapped',{}).get('Freeze',True))
           column.set_decode(l['Decodedef'])
           column.build()
+        clear_checkpoint_cache()
         print "{} added".format(l['Layerdef'])
         
         if l.get('Use_To_Map_Samples',False):
@@ -331,6 +328,7 @@ if __name__ == '__main__':
           stationary_mapping = False
           while(not stationary_mapping ):
             print("========= Epoch {} ========".format(epoch_num))
+            visualize = viz.tick()
             print("Mapping Distribution " + str(immap['n_examples']))
             loss = train(immap, columns, imgkeys, n_batches)
             print("Encoding loss on mapped examples {}").format(loss)
@@ -338,19 +336,29 @@ if __name__ == '__main__':
             epoch_num += n_batches*(float(dp.shape()[0])/dp.get_n_examples())
             n_batches += D_TRAIN_BATCHES
             immap_old = immap
-            immap = map_img_2_col(columns)
+            immap = map_img_2_col(columns, DIAGNOSTIC_RESERVOIR and visualize)
             stationary_mapping,stationary_rate = stationary(immap['key2col'], immap_old['key2col'], l.get('Convergence_threshold',0.0))
             print("{} of the examples were stationary in column mapping".format(stationary_rate))
-            print("Accuracy: {}".format(accuracy(dp,columns,immap)))
+            print(format_scores(accuracy(dp,columns,immap)))
             
             #Visual investigation
-            save_recon(dp,columns,immap)   
-            save_top(dp,columns,immap)       
-            save_exemplars(dp, columns,immap)
-            save_column_means(dp,columns,immap)
+            if visualize:
+              save_recon(dp,columns,immap,viz)
+              save_top(dp,columns,immap,viz)
+              save_exemplars(dp, columns,immap,viz)
+              save_column_means(dp,columns,immap,viz)
             
           for column in columns.values():
             column.save()
+          if SAVE_EMBEDDINGS:
+            save_embedding(dp,columns,layer_number)
+            
+          if QUANTIZATION_REPORT:
+            report = routing_report([columns[i] for i in range(len(columns))], dp)
+            print(report)
+            with open(IMG_DIR+"quantization_report",'a') as fout:
+              fout.write("Layer {}\n".format(layer_number+1))
+              fout.write(report)
             
           if N_COLUMNS > 1:
             col_ent = print_column_entropy(dp,columns,immap)
@@ -362,12 +370,13 @@ if __name__ == '__main__':
             with open(IMG_DIR+"col2key",'w') as fout:
               fout.write(col_ent)
               fout.write(class_ent)
-              fout.write(str(accuracy(dp,columns,immap)))
+              fout.write(format_scores(accuracy(dp,columns,immap))+"\n")
               fout.write(str(immap['col2key']))
               
             #generate mean image for each column
-            save_column_means(dp,columns,immap)
-            print("Accuracy: {}".format(accuracy(dp,columns,immap)))
+            save_column_means(dp,columns,immap,viz)
+            print(format_scores(accuracy(dp,columns,immap)))
+    viz.close()
 
 
 # def accuracy(column_entropies, immap):
@@ -0,0 +1,90 @@
+"""
+Scores of a clustering against the true labels.
+
+Every score is computed from the contingency table of labels against clusters,
+which is built with a single bincount, so scoring tens of thousands of examples takes milliseconds.
+Clusters need not be numbered like the labels, nor be as many.
+"""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def contingency_table(true_labels, clusters):
+  """
+  @param: true_labels Integer array [n] of the true label of each example.
+  @param: clusters Integer array [n] of the cluster, or column, of each example.
+  @return: An int64 array [n labels, n clusters] counting the examples of each label in each cluster.
+  """
+  _, t = np.unique(np.asarray(true_labels).ravel(), return_inverse=True)
+  _, c = np.unique(np.asarray(clusters).ravel(), return_inverse=True)
+  n_clusters = c.max() + 1
+  counts = np.bincount(t*n_clusters + c, minlength=(t.max()+1)*n_clusters)
+  return counts.reshape([-1, n_clusters]).astype(np.int64)
+
+def matched_accuracy(table):
+  """
+  Accuracy after matching clusters one to one with labels so that the most examples agree (the Hungarian algorithm).
+  Examples in clusters left unmatched count as errors.
+  """
+  rows, cols = linear_sum_assignment(-table)
+  return float(table[rows, cols].sum())/table.sum()
+
+def purity(table):
+  """
+  Accuracy when each cluster is labelled with its majority label.
+  """
+  return float(table.max(axis=0).sum())/table.sum()
+
+def _entropy(counts):
+  p = counts[counts > 0]/float(counts.sum())
+  return -np.sum(p*np.log(p))
+
+def nmi(table):
+  """
+  Mutual information of labels and clusters normalized by the geometric mean of their entropies.
+  """
+  n = float(table.sum())
+  rows = table.sum(axis=1)
+  cols = table.sum(axis=0)
+  nz = np.nonzero(table)
+  joint = table[nz]/n
+  mi = np.sum(joint*np.log(joint*n*n/(rows[nz[0]]*cols[nz[1]].astype(np.float64))))
+  h = np.sqrt(_entropy(rows)*_entropy(cols))
+  if h == 0:
+    return 1.0 if _entropy(rows) == _entropy(cols) else 0.0
+  return mi/h
+
+def _pairs(x):
+  x = x.astype(np.float64)
+  return np.sum(x*(x-1))/2
+
+def ari(table):
+  """
+  Adjusted Rand index.  1 for identical partitions, 0 at chance.
+  """
+  n = table.sum()
+  if n < 2:
+    #No pairs to disagree on
+    return 1.0
+  index = _pairs(table)
+  a = _pairs(table.sum(axis=1))
+  b = _pairs(table.sum(axis=0))
+  expected = a*b/_pairs(np.array([n]))
+  maximum = (a + b)/2
+  if maximum == expected:
+    return 1.0
+  return (index - expected)/(maximum - expected)
+
+def evaluate(true_labels, clusters):
+  """
+  @return: A dictionary of 'accuracy', 'nmi', 'ari' and 'purity'.
+  """
+  table = contingency_table(true_labels, clusters)
+  return {'accuracy':matched_accuracy(table),
+          'nmi':nmi(table),
+          'ari':ari(table),
+          'purity':purity(table)}
+
+def format_scores(scores):
+  return "Accuracy {accuracy:.4f} NMI {nmi:.4f} ARI {ari:.4f} Purity {purity:.4f}".format(**scores)
@@ -0,0 +1,136 @@
+"""
+Disk cache of the features a column's frozen encoder prefix produces for each minibatch.
+
+While only the newest layer of a column trains, the layers below it compute the same outputs every epoch.
+The cache runs them once, stores their outputs shard by shard beside the input batches,
+and the training loop feeds the stored features in place of the prefix's top.
+"""
+
+import os
+import cPickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+MANIFEST = "manifest"
+
+
+def quantize(x, dtype):
+  """
+  Converts an array to the cache storage type.
+
+  @return: The stored array and the (min, max) range needed to dequantize it.
+  """
+  if dtype == 'uint8':
+    lo = float(np.min(x))
+    hi = float(np.max(x))
+    scale = 255.0/max(hi-lo, 1e-12)
+    return np.round((x-lo)*scale).astype(np.uint8), (lo,hi)
+  return x.astype(dtype), None
+
+def dequantize(x, value_range):
+  if value_range is None:
+    return np.asarray(x, dtype=np.float32)
+  lo,hi = value_range
+  return x.astype(np.float32)*((hi-lo)/255.0) + lo
+
+
+class FeatureCache(object):
+  """
+  A disk cache of the outputs of a column's frozen encoder prefix.
+
+  Each minibatch of the provider is stored as one shard holding the input batch and the prefix's output for it.
+  Shards are memory mapped, and the most recently used ones are kept decoded in memory.
+  The cache is rebuilt only when the prefix weights differ from those it was built with.
+
+  Note the corruption noise and random crops of the prefix are fixed when the cache is built.
+  """
+
+  def __init__(self, cache_dir, dtype='float16', hot_shards=64):
+    """
+    @param: cache_dir Directory holding the shards.  Created if missing.
+    @param: dtype Storage type of the features: 'float32', 'float16' or 'uint8'.
+                  The input batches, which are the stage's reconstruction targets, are stored as float32 when
+                  dtype is 'uint8' so the loss is never taken against a quantized target, and as dtype otherwise.
+    @param: hot_shards Number of decoded shards to keep in memory.
+    """
+    self.cache_dir = cache_dir
+    self.dtype = dtype
+    self.target_dtype = 'float32' if dtype == 'uint8' else dtype
+    self.hot_shards = hot_shards
+    self._hot = OrderedDict()
+    self.manifest = self.read_manifest()
+
+  def read_manifest(self):
+    filename = os.path.join(self.cache_dir, MANIFEST)
+    if not os.path.isfile(filename):
+      return None
+    with open(filename, 'rb') as fin:
+      return cPickle.load(fin)
+
+  def fingerprint(self, column):
+    h = hashlib.md5()
+    h.update(self.dtype)
+    h.update(self.target_dtype)
+    for w in column.prefix_weights():
+      h.update(np.ascontiguousarray(w).tostring())
+    return h.hexdigest()
+
+  def is_valid(self, column):
+    return self.manifest is not None and self.manifest['fingerprint'] == self.fingerprint(column)
+
+  def shard_file(self, n, kind):
+    return os.path.join(self.cache_dir, "shard{:0>6}_{}.npy".format(n, kind))
+
+  def build(self, column, dp):
+    """
+    Runs the frozen prefix of a column once over the data provider and stores its outputs.
+    Does nothing if the cache already matches the column's prefix weights.
+
+    @return: True if the cache was rebuilt.
+    """
+    if self.is_valid(column):
+      print("Feature cache {} is up to date".format(self.cache_dir))
+      return False
+    print("Building feature cache {}".format(self.cache_dir))
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    for f in os.listdir(self.cache_dir):
+      os.remove(os.path.join(self.cache_dir, f))
+    self._hot.clear()
+    ranges = []
+    for n,mb in enumerate(dp.get_mb()):
+      data = mb[0]
+      features = column.fwd_prefix(data)
+      shard_ranges = []
+      for kind,x,dtype in (('data',data,self.target_dtype), ('features',features,self.dtype)):
+        q,r = quantize(x, dtype)
+        np.save(self.shard_file(n, kind), q)
+        shard_ranges.append(r)
+      ranges.append(shard_ranges)
+    self.manifest = {'fingerprint':self.fingerprint(column), 'ranges':ranges}
+    with open(os.path.join(self.cache_dir, MANIFEST), 'wb') as fout:
+      cPickle.dump(self.manifest, fout, cPickle.HIGHEST_PROTOCOL)
+    return True
+
+  def n_shards(self):
+    return len(self.manifest['ranges'])
+
+  def load(self, n):
+    """
+    Returns shard n as float32 (data, features).
+    """
+    if n in self._hot:
+      shard = self._hot.pop(n)
+    else:
+      shard = tuple([dequantize(np.load(self.shard_file(n, kind), mmap_mode='r'), r)
+                     for kind,r in zip(('data','features'), self.manifest['ranges'][n])])
+      if len(self._hot) >= self.hot_shards:
+        self._hot.popitem(last=False)
+    if self.hot_shards > 0:
+      self._hot[n] = shard
+    return shard
+
+  def get_mb(self):
+    for n in range(self.n_shards()):
+      yield self.load(n)
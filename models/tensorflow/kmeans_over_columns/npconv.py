@@ -0,0 +1,160 @@
+"""
+NumPy convolution kernels matching tf.nn.conv2d and tf.nn.deconv2d.
+Inputs are [batch, y, x, channels].
+conv2d filters are [h, w, in, out] and deconv2d filters are [h, w, out, in].
+Strides are given as in TensorFlow, [1, stride_y, stride_x, 1], or as a single int.
+Padding is 'VALID' or 'SAME' with TensorFlow's placement of the extra pixel after the image.
+
+Run this module to check the kernels against TensorFlow and time both.
+"""
+
+import numpy as np
+
+
+def spatial_strides(strides):
+  if isinstance(strides, int):
+    return (strides, strides)
+  return (strides[1], strides[2])
+
+def output_size(size, filtersize, stride, padding='VALID'):
+  """
+  The output size of a convolution along one dimension.
+  """
+  if padding == 'SAME':
+    return -(-size//stride)
+  return (size-filtersize)//stride + 1
+
+def same_padding(size, filtersize, stride):
+  """
+  The (before, after) zero padding TensorFlow applies along one dimension for SAME convolutions.
+  """
+  total = max((output_size(size, filtersize, stride, 'SAME')-1)*stride + filtersize - size, 0)
+  return (total//2, total - total//2)
+
+def im2col(x, filterdim, strides):
+  """
+  Gathers every filter sized patch of x into a row.  No padding is applied.
+
+  @param: x An [n, y, x, c] array.
+  @param: filterdim [h, w] of the filter.
+  @param: strides The strides, see spatial_strides.
+  @return: An [n, out_y, out_x, h*w*c] array with patches laid out as (h, w, c).
+  """
+  n,y,x_,c = x.shape
+  h,w = filterdim
+  sy,sx = spatial_strides(strides)
+  out_y = (y-h)//sy + 1
+  out_x = (x_-w)//sx + 1
+  cols = np.empty([n, out_y, out_x, h, w, c], dtype=x.dtype)
+  for i in range(h):
+    for j in range(w):
+      cols[:,:,:,i,j,:] = x[:, i:i+sy*out_y:sy, j:j+sx*out_x:sx, :]
+  return cols.reshape([n, out_y, out_x, h*w*c])
+
+def col2im(cols, filterdim, strides, outshape):
+  """
+  Sums patch rows back into an image.  The adjoint of im2col.
+  Pixels of outshape that no patch covers are zero.
+
+  @param: cols An [n, in_y, in_x, h*w*c] array with patches laid out as (h, w, c).
+  @param: filterdim [h, w] of the filter.
+  @param: strides The strides, see spatial_strides.
+  @param: outshape [y, x, c] of the image.  At least as large as the patches cover.
+  @return: An [n, y, x, c] array.
+  """
+  n,in_y,in_x,_ = cols.shape
+  h,w = filterdim
+  sy,sx = spatial_strides(strides)
+  cols = cols.reshape([n, in_y, in_x, h, w, outshape[2]])
+  out = np.zeros([n]+list(outshape), dtype=cols.dtype)
+  for i in range(h):
+    for j in range(w):
+      out[:, i:i+sy*in_y:sy, j:j+sx*in_x:sx, :] += cols[:,:,:,i,j,:]
+  return out
+
+def conv2d(x, W, strides, padding='VALID'):
+  """
+  Convolution matching tf.nn.conv2d.
+  """
+  h,w,cin,cout = W.shape
+  if padding == 'SAME':
+    sy,sx = spatial_strides(strides)
+    x = np.pad(x, [(0,0), same_padding(x.shape[1], h, sy), same_padding(x.shape[2], w, sx), (0,0)], 'constant')
+  cols = im2col(x, [h,w], strides)
+  return np.dot(cols.reshape([-1, h*w*cin]), W.reshape([h*w*cin, cout])).reshape(cols.shape[:3]+(cout,))
+
+def deconv2d(x, W, output_shape=None, strides=1, padding='VALID'):
+  """
+  Transposed convolution matching tf.nn.deconv2d, the gradient of conv2d with respect to its input.
+
+  @param: output_shape [n, y, x, c] of the result.
+                       Defaults to the smallest output conv2d maps onto the input's size.
+  """
+  h,w,cout,cin = W.shape
+  n,y,x_,_ = x.shape
+  sy,sx = spatial_strides(strides)
+  if output_shape is None:
+    if padding == 'SAME':
+      output_shape = [n, y*sy, x_*sx, cout]
+    else:
+      output_shape = [n, (y-1)*sy + h, (x_-1)*sx + w, cout]
+  out_y,out_x = output_shape[1:3]
+  before_y,before_x = (0,0)
+  if padding == 'SAME':
+    before_y = same_padding(out_y, h, sy)[0]
+    before_x = same_padding(out_x, w, sx)[0]
+  cols = np.dot(x.reshape([-1, cin]), W.reshape([h*w*cout, cin]).T).reshape([n, y, x_, h*w*cout])
+  padded = [max(before_y+out_y, (y-1)*sy + h), max(before_x+out_x, (x_-1)*sx + w), cout]
+  out = col2im(cols, [h,w], strides, padded)
+  return out[:, before_y:before_y+out_y, before_x:before_x+out_x, :]
+
+
+if __name__ == '__main__':
+  import time
+  import tensorflow as tf
+
+  def bench(f, n=10):
+    f()
+    start = time.time()
+    for i in range(n):
+      r = f()
+    return r, (time.time()-start)/n
+
+  #(input shape, filter h/w, filter in, filter out, stride, padding)
+  conv_cases = [([64,31,31,3], 5, 3, 8, 2, 'VALID'),
+                ([64,13,13,8], 5, 8, 32, 2, 'VALID'),
+                ([64,5,5,32], 3, 32, 128, 1, 'VALID'),
+                ([64,28,28,1], 5, 1, 2, 2, 'SAME'),
+                ([64,13,13,8], 4, 8, 16, 3, 'SAME')]
+  #The cifar and mnist decoders of column_definition, plus SAME cases
+  #(input shape, filter h/w, filter out, filter in, stride, padding)
+  deconv_cases = [([64,13,13,8], 7, 3, 8, 2, 'VALID'),
+                  ([64,5,5,32], 15, 3, 32, 4, 'VALID'),
+                  ([64,3,3,128], 23, 3, 128, 4, 'VALID'),
+                  ([64,12,12,2], 5, 1, 2, 2, 'VALID'),
+                  ([64,1,1,2], 27, 1, 2, 27, 'VALID'),
+                  ([64,14,14,2], 5, 1, 2, 2, 'SAME'),
+                  ([64,5,5,16], 4, 8, 16, 3, 'SAME')]
+
+  s = tf.Session()
+  print("{:<8} {:<20} {:<16} {:<8} {:<12} {:<12} {:<12}".format("op","input","filter","padding","max error","numpy (s)","tf (s)"))
+  for shape,k,a,b,stride,padding in conv_cases:
+    x = np.random.rand(*shape).astype(np.float32)
+    W = np.random.randn(k,k,a,b).astype(np.float32)
+    strides = [1,stride,stride,1]
+    op = tf.nn.conv2d(tf.constant(x), tf.constant(W), strides, padding)
+    expected, tf_time = bench(lambda: s.run(op))
+    result, np_time = bench(lambda: conv2d(x, W, strides, padding))
+    print("{:<8} {:<20} {:<16} {:<8} {:<12.3g} {:<12.4f} {:<12.4f}".format("conv", shape, [k,k,a,b], padding, np.max(np.abs(result-expected)), np_time, tf_time))
+  for shape,k,a,b,stride,padding in deconv_cases:
+    x = np.random.rand(*shape).astype(np.float32)
+    W = np.random.randn(k,k,a,b).astype(np.float32)
+    strides = [1,stride,stride,1]
+    if padding == 'SAME':
+      output_shape = [shape[0], shape[1]*stride, shape[2]*stride, a]
+    else:
+      output_shape = [shape[0], (shape[1]-1)*stride + k, (shape[2]-1)*stride + k, a]
+    op = tf.nn.deconv2d(tf.constant(x), tf.constant(W), output_shape, strides, padding)
+    expected, tf_time = bench(lambda: s.run(op))
+    result, np_time = bench(lambda: deconv2d(x, W, output_shape, strides, padding))
+    print("{:<8} {:<20} {:<16} {:<8} {:<12.3g} {:<12.4f} {:<12.4f}".format("deconv", shape, [k,k,a,b], padding, np.max(np.abs(result-expected)), np_time, tf_time))
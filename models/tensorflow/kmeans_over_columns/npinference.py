@@ -0,0 +1,116 @@
+"""
+A NumPy inference engine for exported AutoEncoder columns.
+
+A column is exported once from TensorFlow with export_column, or save_records for quantized records,
+and loaded with load_column without building graphs, sessions or savers.
+"""
+
+import json
+import numpy as np
+import npconv
+
+EPSILON  = 0.0000001
+
+ACTIVATIONS = {'sigmoid':lambda x: 0.5*(1.0+np.tanh(0.5*x)),
+               'relu':lambda x: np.maximum(x, 0),
+               'tanh':np.tanh}
+
+
+def save_records(records, filename, input_shape=None):
+  """
+  Writes exported layer records to an .npz file.
+
+  @param: records Records from AutoEncoder.export_layers() or quantize.quantize_records().
+  @param: filename The file to write.
+  @param: input_shape The shape of one example, stored for reference.
+  """
+  meta = {'input_shape':input_shape, 'layers':[]}
+  arrays = {}
+  for i,r in enumerate(records):
+    layer = dict([(k,v) for k,v in r.iteritems() if k not in ('weights','axis')])
+    w,b = r['weights']
+    if isinstance(w, tuple):
+      #Store per channel parameters broadcastable against the weight
+      q,scale,zero_point = w
+      shape = [1]*q.ndim
+      shape[r['axis']] = q.shape[r['axis']]
+      arrays['layer{}_q'.format(i)] = q
+      arrays['layer{}_scale'.format(i)] = scale.reshape(shape)
+      arrays['layer{}_zero_point'.format(i)] = zero_point.reshape(shape).astype(np.float32)
+      layer['quantized'] = True
+    else:
+      arrays['layer{}_W'.format(i)] = w
+      layer['quantized'] = False
+    arrays['layer{}_b'.format(i)] = b
+    meta['layers'].append(layer)
+  np.savez(filename, meta=np.array(json.dumps(meta)), **arrays)
+
+def export_column(column, filename):
+  """
+  Writes a column's encoder and current decoder to an .npz file.
+  """
+  save_records(column.export_layers(), filename, column.bottom_shape()[1:])
+
+def load_column(filename):
+  return NumpyColumn(filename)
+
+
+class NumpyColumn(object):
+  """
+  An exported column evaluated with NumPy.
+  Mirrors the inference methods of AutoEncoder, without corruption.
+  """
+
+  def __init__(self, filename):
+    f = np.load(filename)
+    meta = json.loads(str(f['meta']))
+    self.input_shape = meta['input_shape']
+    self.layers = []
+    for i,layer in enumerate(meta['layers']):
+      if layer['quantized']:
+        W = (f['layer{}_q'.format(i)].astype(np.float32) - f['layer{}_zero_point'.format(i)])*f['layer{}_scale'.format(i)]
+      else:
+        W = f['layer{}_W'.format(i)]
+      self.layers.append((layer, W, f['layer{}_b'.format(i)]))
+
+  def apply(self, x, layer, W, b):
+    f = ACTIVATIONS[layer['activation']]
+    if layer['type'] == 'fc':
+      flat = x.reshape([len(x), -1])
+      if layer['direction'] == 'encode':
+        return f(np.dot(flat, W) + b)
+      outdim = layer['outdim'] if isinstance(layer['outdim'], list) else [layer['outdim']]
+      return f(np.dot(flat, W.T) + b).reshape([len(x)] + outdim)
+    if layer['direction'] == 'encode':
+      return f(npconv.conv2d(x, W, layer['strides'], layer['padding']) + b)
+    outshape = [len(x),
+                (x.shape[1]-1)*layer['strides'][1] + layer['filterdim'][0],
+                (x.shape[2]-1)*layer['strides'][2] + layer['filterdim'][1],
+                layer['outdim']]
+    return f(npconv.deconv2d(x, W, outshape, layer['strides'], layer['padding']) + b)
+
+  def fwd(self, data):
+    x = data
+    for layer,W,b in self.layers:
+      if layer['direction'] == 'encode':
+        x = self.apply(x, layer, W, b)
+    return x
+
+  def inject(self, top):
+    x = top
+    for layer,W,b in self.layers:
+      if layer['direction'] == 'decode':
+        x = self.apply(x, layer, W, b)
+    return x
+
+  def fwd_back(self, data):
+    return (data, self.inject(self.fwd(data)))
+
+  def per_example_reconstruction_loss(self, data):
+    _,recon = self.fwd_back(data)
+    ce = data*np.log(EPSILON+recon) + (1-data)*np.log(1-recon+EPSILON)
+    return -np.mean(ce.reshape([len(data), -1]), axis=1)
+
+  def loss(self, data):
+    _,recon = self.fwd_back(data)
+    return np.mean(np.abs(data-recon))
@@ -0,0 +1,155 @@
+"""
+Static shape planner for LAYERS definitions.
+
+Walks a LAYERS list without building graphs and reports, for each greedy stage,
+the encoder and decoder shapes, parameter counts, FLOPs per example and activation memory per batch.
+Decoders that do not reconstruct the input shape and VALID convolutions that drop border pixels are flagged.
+
+Usage: python planner.py [<number of columns>]
+"""
+
+import sys
+from operator import mul
+import numpy as np
+from npconv import output_size
+
+
+def layer_kind(d):
+  if hasattr(d, 'filterdim'):
+    return 'conv'
+  if hasattr(d, 'outdim_flat'):
+    return 'fc'
+  return 'passthrough'
+
+def size(shape):
+  return reduce(mul, shape, 1)
+
+def plan_layer(d, inshape, direction):
+  """
+  Computes the output shape and cost of one layer.
+
+  @param: d A LayerDef.
+  @param: inshape Shape of one example entering the layer, [y, x, c] or [n].
+  @param: direction 'encode' or 'decode'.
+  @return: A dict with 'name', 'inshape', 'outshape', 'params', 'flops' and 'problems'.
+  """
+  kind = layer_kind(d)
+  p = {'name':"{} {}".format(direction, kind), 'inshape':list(inshape), 'problems':[]}
+  if kind == 'conv':
+    if len(inshape) != 3:
+      p['problems'].append("ERROR: {} expects an image but gets shape {}".format(p['name'], inshape))
+      p.update({'outshape':list(inshape), 'params':0, 'flops':0})
+      return p
+    h,w = d.filterdim()
+    _,sy,sx,_ = d.strides()
+    padding = d._padding
+    y,x,cin = inshape
+    cout = d.outdim()
+    if direction == 'encode':
+      outshape = [output_size(y, h, sy, padding), output_size(x, w, sx, padding), cout]
+      if padding == 'VALID':
+        for axis,dim,k,s in (('y',y,h,sy), ('x',x,w,sx)):
+          if (dim-k) % s:
+            p['problems'].append("WARNING: {} with filter {} and stride {} drops {} of {} pixels along {}".format(
+                                 p['name'], k, s, (dim-k) % s, dim, axis))
+      p['flops'] = 2*h*w*cin*cout*outshape[0]*outshape[1]
+    else:
+      #Decoders always produce the output the matching VALID convolution would consume
+      outshape = [(y-1)*sy + h, (x-1)*sx + w, cout]
+      p['flops'] = 2*h*w*cin*cout*y*x
+    p['params'] = h*w*cin*cout + cout
+    if min(outshape) <= 0:
+      p['problems'].append("ERROR: {} produces an empty output {}".format(p['name'], outshape))
+  elif kind == 'fc':
+    n = size(inshape)
+    outshape = d.outdim()
+    m = d.outdim_flat()
+    p['params'] = n*m + m
+    p['flops'] = 2*n*m
+  else:
+    outshape = list(inshape)
+    p['params'] = 0
+    p['flops'] = 0
+  p['outshape'] = list(outshape)
+  return p
+
+def plan_layers(layers, input_shape, batch_size=1, bytes_per_value=4):
+  """
+  Plans every greedy stage of a LAYERS list.
+  Stage i trains encoder layers up to i with the decoders of layer i, and must reconstruct the input.
+
+  @param: layers A LAYERS list as in column_definition.
+  @param: input_shape Shape of one example from the data provider.
+  @param: batch_size Examples per minibatch.
+  @param: bytes_per_value Size of one activation value.
+  @return: A list of stage dicts with 'encoder' and 'decoder' layer plans, 'params', 'flops',
+           'activation_bytes' and 'problems'.
+  """
+  stages = []
+  encoder = []
+  shape = list(input_shape)
+  for i,l in enumerate(layers):
+    p = plan_layer(l['Layerdef'], shape, 'encode')
+    encoder.append(p)
+    shape = p['outshape']
+    if 'Decodedef' not in l:
+      continue
+    decoder = []
+    recon = shape
+    for ddef in l['Decodedef']:
+      q = plan_layer(ddef, recon, 'decode')
+      decoder.append(q)
+      recon = q['outshape']
+    stage_problems = [m for q in encoder[-1:]+decoder for m in q['problems']]
+    if list(recon) != list(input_shape):
+      stage_problems.append("ERROR: decoder reconstructs {} but the input is {}".format(recon, list(input_shape)))
+    values = size(input_shape) + sum([size(q['outshape']) for q in encoder+decoder])
+    stages.append({'layer':i+1,
+                   'encoder':list(encoder),
+                   'decoder':decoder,
+                   'params':sum([q['params'] for q in encoder+decoder]),
+                   'flops':sum([q['flops'] for q in encoder+decoder]),
+                   'activation_bytes':values*batch_size*bytes_per_value,
+                   'problems':stage_problems})
+  return stages
+
+def problems(stages):
+  return [m for s in stages for m in s['problems']]
+
+def format_bytes(n):
+  for unit in ['B','KB','MB','GB']:
+    if n < 1024 or unit == 'GB':
+      return "{:.1f}{}".format(n, unit)
+    n /= 1024.0
+
+def format_plan(stages, n_columns=1):
+  """
+  @return: A printable report of the planned stages.
+  """
+  output = ""
+  for s in stages:
+    output += "Stage {}\n".format(s['layer'])
+    for q in s['encoder']+s['decoder']:
+      output += "  {:<18} {:<16} -> {:<16} params {:<10} MFLOPs {:.3f}\n".format(
+                q['name'], q['inshape'], q['outshape'], q['params'], q['flops']/1e6)
+    output += "  Params {}, MFLOPs per example {:.3f} (about {:.3f} to train), activations per batch {}\n".format(
+              s['params'], s['flops']/1e6, 3*s['flops']/1e6, format_bytes(s['activation_bytes']))
+    if n_columns > 1:
+      output += "  {} columns: activations {}, float32 weights with optimizer state {}\n".format(
+                n_columns, format_bytes(n_columns*s['activation_bytes']), format_bytes(n_columns*s['params']*4*2))
+    for m in s['problems']:
+      output += "  {}\n".format(m)
+  return output
+
+
+if __name__ == '__main__':
+  from column_definition import LAYERS, DATA_PARAM, TRANSFORM_PARAM, DATA_PROVIDER, N_COLUMNS
+  from dataio import MnistDataProvider
+  n_columns = int(sys.argv[1]) if len(sys.argv) > 1 else N_COLUMNS
+  channels = 1 if DATA_PROVIDER is MnistDataProvider else 3
+  input_shape = [TRANSFORM_PARAM.crop_size, TRANSFORM_PARAM.crop_size, channels]
+  stages = plan_layers(LAYERS, input_shape, DATA_PARAM.batch_size, np.dtype(TRANSFORM_PARAM.dtype).itemsize)
+  print("Input {}, batch size {}".format(input_shape, DATA_PARAM.batch_size))
+  print(format_plan(stages, n_columns))
+  if [m for m in problems(stages) if m.startswith("ERROR")]:
+    sys.exit(1)
@@ -17,16 +17,22 @@ from PIL import Image
 import math
 import weights_to_img as w2i
 from os import path
-from column_definition import LAYERS,DATA_PARAM,TRANSFORM_PARAM,NUM_LABELS, get_dp
-from util import save_recon,save_top,save_injection
+from column_definition import LAYERS,DATA_PARAM,TRANSFORM_PARAM,NUM_LABELS, get_dp, PRELOAD_DATA, LAYERWISE_GRAPHS, FEATURE_CACHE_DTYPE, FEATURE_CACHE_HOT_SHARDS, N_VALIDATION_EXAMPLES, EVAL_EVERY, SAVE_EMBEDDINGS
+from planner import plan_layers, format_plan
+from util import save_recon,save_top,save_injection,save_embedding
+from feature_cache import FeatureCache
+from training import train
             
 
-def pretrain_epoch(column,dp, i):
+def pretrain_epoch(column,dp, i, cache=None):
     print("Pretrain epoch {}".format(i))
-    loss = 0
-    n = 0
+    if cache:
+      for data,features in cache.get_mb():
+        column.train_mb(data, fetch_loss=False, features=features)
+      return column.accumulated_loss()
+    if column.encode_layers[0].preload:
+      return np.mean(column.train_steps(dp.get_n_examples()//dp.shape()[0]))
     for mb in dp.get_mb():
-      n += 1
 #       if n < 10:
 #         d,r = column.fwd_back(mb[0])
 #         print("Recon max {}".format(np.max(r)))
@@ -34,9 +40,8 @@ def pretrain_epoch(column,dp, i):
 #         plt.set_cmap('gray')
 #         plt.colorbar()
 #         plt.show()
-      loss += column.train_mb(mb[0])
-    loss /= n
-    return loss
+      column.train_mb(mb[0], fetch_loss=False)
+    return column.accumulated_loss()
   
  
 
@@ -50,11 +55,17 @@ if __name__ == '__main__':
     IMG_DIR =  path.join(BASE_PATH,'img/')
     CHECKPOINT_DIR =  path.join(BASE_PATH,'check/')
     dp = get_dp(DATA_PARAM,TRANSFORM_PARAM )
+    print(format_plan(plan_layers(LAYERS, dp.shape()[1:], dp.shape()[0], dp.dtype.itemsize)))
+    holdout = None
+    validation = None
+    if N_VALIDATION_EXAMPLES > 0:
+      holdout = dp.split_holdout(N_VALIDATION_EXAMPLES)
+      validation = holdout[0]
     imgkeys = dp.get_keys()
     with tf.Session() as sess:
       g = tf.Graph()
       s = tf.Session(graph=g)
-      column = AutoEncoder(s,g,dp,LOG_DIR, CHECKPOINT_DIR)
+      column = AutoEncoder(s,g,dp,LOG_DIR, CHECKPOINT_DIR, preload=PRELOAD_DATA, layerwise=LAYERWISE_GRAPHS)
       print "Column Initialized"
       
       
@@ -64,37 +75,29 @@ if __name__ == '__main__':
         if l.get('Train',True):
           column.set_decode(l['Decodedef'])
           column.build()
+          clear_checkpoint_cache()
         print "{} added".format(l['Layerdef'])
         
         l_params = l.get('All',{})
+        cache = None
         if l.get('Train',True) and  l_params.get('N_epochs',0) != 0:
+          if FEATURE_CACHE_DTYPE and column.prefix_frozen():
+            cache = FeatureCache(path.join(CHECKPOINT_DIR,'features_level'+str(layer_number)), FEATURE_CACHE_DTYPE, FEATURE_CACHE_HOT_SHARDS)
+            cache.build(column, dp)
           #Pretrain on all data
-          if l_params.get('N_epochs',0) > 0:
-            for i in range(l_params.get('N_epochs',0)):
-              loss = pretrain_epoch(column, dp, i)
-              print("\tAve loss: {}".format(loss))
-          elif l_params.get('N_epochs',0) == -1:
-            loss = 100
-            best_loss = loss
-            patience = 0
-            i = 0
-            while patience < l_params.get("Patience",0):
-              best_loss = min(best_loss,loss)
-              loss = pretrain_epoch(column, dp, i)
-              if (loss - best_loss)/abs(best_loss)  < -l_params.get("Patience_delta",0.1):
-                patience = 0
-              else:
-                patience += 1
-              if loss < best_loss:
-                print("\tAve loss: {} *** {}".format(loss,patience))
-              else:
-                print("\tAve loss: {}     {}".format(loss,patience))
-              i += 1
+          loss = train(column,
+                       lambda i: pretrain_epoch(column, dp, i, cache),
+                       l_params.get('N_epochs',0),
+                       validation,
+                       l_params.get("Patience",0),
+                       l_params.get("Patience_delta",0.1),
+                       EVAL_EVERY)
           print "Layer {} trained on all data {} epochs".format(layer_number+1,l_params.get('N_epochs',0))
           column.save()
           with open(path.join(IMG_DIR,"col_pretrain_losses".format(layer_number)),"a") as fout:
             fout.write(str(layer_number)+": "+str(loss)+"\n")
-#           save_embedding(column,dp)
+          if SAVE_EMBEDDINGS:
+            save_embedding(column,dp,layer_number,CHECKPOINT_DIR,holdout)
 
           #Visual investigation
           save_recon(dp.get_mb().next()[0],column,"pretrain", layer_number,IMG_DIR)  
@@ -17,8 +17,10 @@ from PIL import Image
 import math
 import weights_to_img as w2i
 from os import path
-from column_definition import LAYERS,DATA_PARAM,TRANSFORM_PARAM,NUM_LABELS,get_dp,N_LABELED_EXAMPLES
-from util import save_recon,save_top,save_injection,get_label_batch
+from column_definition import LAYERS,DATA_PARAM,TRANSFORM_PARAM,NUM_LABELS,get_dp,N_LABELED_EXAMPLES,LAYERWISE_GRAPHS,N_LABELED_VALIDATION_EXAMPLES,LABELED_EVAL_EVERY,SAVE_EMBEDDINGS
+from planner import plan_layers, format_plan
+from util import save_recon,save_top,save_injection,get_label_batch,save_embeddings
+from training import train
 
 
 
@@ -34,13 +36,17 @@ if __name__ == '__main__':
     IMG_DIR =  path.join(BASE_PATH,'img/')
     CHECKPOINT_DIR =  path.join(BASE_PATH,'check/')
     dp = get_dp(DATA_PARAM,TRANSFORM_PARAM )
+    print(format_plan(plan_layers(LAYERS, dp.shape()[1:], dp.shape()[0], dp.dtype.itemsize)))
     imgkeys = dp.get_keys()
     with tf.Session() as sess:
       for label in range(NUM_LABELS):
         g = tf.Graph()
         s = tf.Session(graph=g)
-        column = AutoEncoder(s,g,dp,LOG_DIR, CHECKPOINT_DIR, colnum=label)
+        column = AutoEncoder(s,g,dp,LOG_DIR, CHECKPOINT_DIR, colnum=label, layerwise=LAYERWISE_GRAPHS)
         data = get_label_batch(dp,label,N_LABELED_EXAMPLES)
+        validation = None
+        if N_LABELED_VALIDATION_EXAMPLES > 0:
+          validation = get_label_batch(dp,label,N_LABELED_VALIDATION_EXAMPLES,N_LABELED_EXAMPLES)
         print "Column Initialized"
         
         
@@ -54,31 +60,19 @@ if __name__ == '__main__':
           
           l_params = l.get('Labeled',{})
           if l.get('Train',True):
-            #Pretrain on all data
-            if l_params.get('N_epochs',0) > 0:
-              for i in range(l_params.get('N_epochs',0)):
-                loss = column.train_mb(data)
-                print("\tAve loss: {}".format(loss))
-            elif l_params.get('N_epochs',0) == -1:
-              loss = 100
-              best_loss = loss
-              patience = 0
-              i = 0
-              while patience < l_params.get("Patience",0):
-                best_loss = min(best_loss,loss)
-                loss = column.train_mb(data)
-                if (loss - best_loss)/abs(best_loss)  < -l_params.get("Patience_delta",0.1):
-                  patience = 0
-                else:
-                  patience += 1
-                if loss < best_loss:
-                  print("\tAve loss: {} *** {}".format(loss,patience))
-                else:
-                  print("\tAve loss: {}     {}".format(loss,patience))
-                i += 1
+            #Pretrain on the labeled examples, one step per epoch
+            if l_params.get('N_epochs',0) != 0:
+              loss = train(column,
+                           lambda i: column.train_mb(data),
+                           l_params.get('N_epochs',0),
+                           validation,
+                           l_params.get("Patience",0),
+                           l_params.get("Patience_delta",0.1),
+                           LABELED_EVAL_EVERY)
             print "Layer {} trained on all data {} epochs".format(layer_number+1,l_params.get('N_epochs',0))
             column.save()
-#             save_embedding(column,dp, label)
+            if SAVE_EMBEDDINGS:
+              save_embeddings([column], dp, CHECKPOINT_DIR, "embedding_label{}_level{}".format(label, layer_number))
   
             #Visual investigation
             save_recon(dp.get_mb().next()[0],column,label, layer_number,IMG_DIR)  
@@ -0,0 +1,167 @@
+"""
+Post training int8 quantization of AutoEncoder columns for routing.
+
+Conv and FC weights are quantized per output channel to int8 with a scale and zero point.
+Biases stay float32.  The runner dequantizes weights on the graph and computes
+the per example reconstruction loss on the CPU, without corruption, optimizers or checkpoints.
+"""
+
+import numpy as np
+import tensorflow as tf
+from autoencoder import ACTIVATIONS, cross_entropy
+
+
+def output_axis(record):
+  """
+  The axis of a layer's weight that indexes its output channels.
+  """
+  if record['type'] == 'conv':
+    #encode filters are [h,w,in,out], deconv filters are [h,w,out,in]
+    return 3 if record['direction'] == 'encode' else 2
+  #encode weights are [in,out], decode weights are [out,in] and applied transposed
+  return 1 if record['direction'] == 'encode' else 0
+
+def quantize_weights(w, axis):
+  """
+  Quantizes an array to int8 per slice along axis.
+  The range of each slice is widened to include zero so zero is represented exactly.
+
+  @return: (q, scale, zero_point) where w ~= (q - zero_point)*scale along axis.
+  """
+  x = np.rollaxis(w, axis, 0).reshape([w.shape[axis], -1])
+  lo = np.minimum(x.min(axis=1), 0.0)
+  hi = np.maximum(x.max(axis=1), 0.0)
+  scale = (hi-lo)/255.0
+  scale[scale == 0] = 1.0
+  zero_point = np.clip(np.round(-128 - lo/scale), -128, 127).astype(np.int32)
+  q = np.clip(np.round(x/scale[:,None]) + zero_point[:,None], -128, 127).astype(np.int8)
+  q = np.rollaxis(q.reshape([w.shape[axis]] + [d for i,d in enumerate(w.shape) if i != axis]), 0, axis+1)
+  return q, scale.astype(np.float32), zero_point
+
+def channel_shape(w, axis):
+  shape = [1]*w.ndim
+  shape[axis] = w.shape[axis]
+  return shape
+
+def dequantize_weights(q, scale, zero_point, axis):
+  shape = channel_shape(q, axis)
+  return (q.astype(np.float32) - zero_point.reshape(shape))*scale.reshape(shape)
+
+def quantize_records(records):
+  """
+  Replaces the float weight of every exported layer record with its int8 quantization.
+
+  @param: records Layer records from AutoEncoder.export_layers().
+  @return: New records where 'weights' is [(q, scale, zero_point), bias].
+  """
+  quantized = []
+  for r in records:
+    r = dict(r)
+    w,b = r['weights']
+    r['axis'] = output_axis(r)
+    r['weights'] = [quantize_weights(w, r['axis']), b]
+    quantized.append(r)
+  return quantized
+
+def weight_bytes(records):
+  n = 0
+  for r in records:
+    for w in r['weights']:
+      if isinstance(w, tuple):
+        n += sum([a.nbytes for a in w])
+      else:
+        n += w.nbytes
+  return n
+
+
+class Runner(object):
+  """
+  Computes the per example reconstruction loss of an exported column on the CPU.
+  Accepts float records from AutoEncoder.export_layers() or int8 records from quantize_records().
+  """
+
+  def __init__(self, records, input_shape):
+    """
+    @param: records The exported layers.
+    @param: input_shape The shape of one example, without the batch dimension.
+    """
+    self.g = tf.Graph()
+    with self.g.as_default(), self.g.device('/cpu:0'):
+      self.data = tf.placeholder(tf.float32, [None]+list(input_shape), "data")
+      x = self.data
+      for r in records:
+        x = self.build_layer(x, r)
+      recon = x
+      self.per_example_loss = tf.reduce_mean(-cross_entropy(self.data, recon),
+                                             reduction_indices=range(1, recon.get_shape().ndims))
+    self.s = tf.Session(graph=self.g)
+
+  def weight(self, r):
+    w = r['weights'][0]
+    if not isinstance(w, tuple):
+      return tf.constant(w)
+    q,scale,zero_point = w
+    shape = channel_shape(q, r['axis'])
+    return (tf.cast(tf.constant(q), tf.float32) - zero_point.reshape(shape).astype(np.float32))*scale.reshape(shape)
+
+  def build_layer(self, x, r):
+    W = self.weight(r)
+    b = tf.constant(r['weights'][1])
+    f = ACTIVATIONS[r['activation']]
+    if r['type'] == 'fc':
+      flat = tf.reshape(x, [-1, np.prod(x.get_shape().as_list()[1:])])
+      if r['direction'] == 'encode':
+        return f(tf.matmul(flat, W) + b)
+      return tf.reshape(f(tf.matmul(flat, tf.transpose(W)) + b), [-1]+list(r['outdim']))
+    if r['direction'] == 'encode':
+      return f(tf.nn.conv2d(x, W, r['strides'], r['padding']) + b)
+    inshape = x.get_shape().as_list()
+    outshape = [(inshape[1]-1)*r['strides'][1] + r['filterdim'][0],
+                (inshape[2]-1)*r['strides'][2] + r['filterdim'][1],
+                r['outdim']]
+    y = tf.nn.deconv2d(x, W, tf.pack([tf.shape(x)[0]]+outshape), r['strides'], padding=r['padding'])
+    y.set_shape([None]+outshape)
+    return f(y + b)
+
+  def per_example_reconstruction_loss(self, data):
+    return self.s.run(self.per_example_loss, feed_dict={self.data:data})
+
+  def close(self):
+    self.s.close()
+
+
+def routing_report(columns, dp):
+  """
+  Compares routing with int8 quantized columns against float32 columns over the whole data provider.
+  Both are run through the same Runner, so differences come from quantization alone.
+
+  @param: columns A list of AutoEncoders.
+  @param: dp The data provider to route.
+  @return: A printable report.
+  """
+  input_shape = dp.shape()[1:]
+  exports = [c.export_layers() for c in columns]
+  quantized = [quantize_records(r) for r in exports]
+  float_runners = [Runner(r, input_shape) for r in exports]
+  int8_runners = [Runner(r, input_shape) for r in quantized]
+  agree = 0
+  n = 0
+  abs_err = 0.0
+  rel_err = 0.0
+  for mb in dp.get_mb(tail=True):
+    data = mb[0].astype(np.float32)
+    f = np.stack([r.per_example_reconstruction_loss(data) for r in float_runners], axis=1)
+    q = np.stack([r.per_example_reconstruction_loss(data) for r in int8_runners], axis=1)
+    agree += np.sum(np.argmin(f, axis=1) == np.argmin(q, axis=1))
+    abs_err += np.sum(np.abs(f-q))
+    rel_err += np.sum(np.abs(f-q)/np.maximum(np.abs(f), 1e-12))
+    n += len(data)
+  for r in float_runners + int8_runners:
+    r.close()
+  output = "Quantized routing report\n"
+  output += "Examples: {}\n".format(n)
+  output += "Routing agreement with float32: {}\n".format(float(agree)/max(n,1))
+  output += "Mean absolute loss error: {}\n".format(abs_err/max(n*len(columns),1))
+  output += "Mean relative loss error: {}\n".format(rel_err/max(n*len(columns),1))
+  output += "Weight bytes float32: {}, int8: {}\n".format(sum(map(weight_bytes, exports)), sum(map(weight_bytes, quantized)))
+  return output
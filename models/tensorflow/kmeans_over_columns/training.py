@@ -0,0 +1,67 @@
+"""
+Training loop shared by the pretraining scripts.
+
+A stage runs either a fixed number of epochs, or until the monitored loss stops improving.
+The monitored loss is the reconstruction loss on held out examples when they are given, otherwise the training loss.
+The best weights are snapshotted in memory and restored when training stops.
+"""
+
+
+def validation_loss(column, data, batch_size):
+  """
+  Mean reconstruction loss of a column over held out examples, evaluated a minibatch at a time.
+  The loss is taken without corruption or weight decay, so it only changes when the weights do.
+  """
+  total = 0.0
+  for i in range(0, len(data), batch_size):
+    mb = data[i:i+batch_size]
+    total += column.clean_loss(mb)*len(mb)
+  return total/len(data)
+
+def train(column, epoch, n_epochs=-1, validation=None, patience=15, patience_delta=0.0001, eval_every=1):
+  """
+  Trains the current stage of a column.
+
+  @param: column The AutoEncoder to train.  build() must have been called.
+  @param: epoch A callable taking the epoch number that trains one epoch and returns its mean training loss.
+  @param: n_epochs The number of epochs to run, or -1 to stop early.
+  @param: validation Held out examples to monitor.  If None the training loss is monitored.
+  @param: patience Number of evaluations without improvement before stopping early.
+  @param: patience_delta Relative decrease of the monitored loss that counts as an improvement.
+  @param: eval_every Number of epochs between evaluations.
+  @return: The best monitored loss when stopping early, otherwise the last one.
+  """
+  best_loss = None
+  best_weights = None
+  waited = 0
+  i = 0
+  loss = None
+  while (n_epochs < 0 and waited < patience) or i < n_epochs:
+    train_loss = epoch(i)
+    i += 1
+    if i % eval_every != 0 and i != n_epochs:
+      print("\tAve loss: {}".format(train_loss))
+      continue
+    if validation is not None:
+      loss = validation_loss(column, validation, column.dp.shape()[0])
+    else:
+      loss = train_loss
+    if best_loss is None or best_loss - loss > patience_delta*abs(best_loss):
+      waited = 0
+    else:
+      waited += 1
+    marker = "   "
+    if best_loss is None or loss < best_loss:
+      best_loss = loss
+      marker = "***"
+      if n_epochs < 0:
+        best_weights = column.snapshot()
+    if validation is not None:
+      print("\tAve loss: {} validation: {} {} {}".format(train_loss, loss, marker, waited))
+    else:
+      print("\tAve loss: {} {} {}".format(loss, marker, waited))
+  if best_weights is not None:
+    column.restore_snapshot(best_weights)
+    print("\tRestored weights with loss {}".format(best_loss))
+    return best_loss
+  return loss
@@ -0,0 +1,124 @@
+"""
+Preprocessing transforms the data providers apply to every minibatch.
+
+Each transform maps a float batch of normalized, uncropped n,y,x,c images to a batch of the same shape,
+so preprocessing variants are switched in TRANSFORM_PARAM.transforms instead of by rewriting datasets.
+"""
+
+import numpy as np
+from zca import ZCA
+
+#Kernels are truncated at this many standard deviations, as in scipy.ndimage.gaussian_filter
+TRUNCATE = 4.0
+
+_blur_matrices = {}
+
+
+def gaussian_kernel(sigma):
+  r = int(TRUNCATE*sigma + 0.5)
+  x = np.arange(-r, r+1, dtype=np.float64)
+  k = np.exp(-0.5*np.square(x)/sigma**2)
+  return k/np.sum(k)
+
+def blur_matrix(sigma, size):
+  """
+  The matrix of a 1-d Gaussian blur along an axis of length size, with borders reflected as in scipy.ndimage.gaussian_filter.
+  Matrices are cached per (sigma, size).
+
+  @return: A float32 array [size, size] whose row i holds the weights of output pixel i.
+  """
+  key = (sigma, size)
+  if key not in _blur_matrices:
+    k = gaussian_kernel(sigma)
+    r = len(k)//2
+    #Source pixel of every tap of every output pixel, reflected at the borders
+    source = np.pad(np.arange(size), r, 'symmetric')[np.arange(size)[:,np.newaxis] + np.arange(2*r+1)]
+    m = np.zeros([size, size], dtype=np.float64)
+    np.add.at(m, (np.repeat(np.arange(size), 2*r+1), source.ravel()), np.tile(k, size))
+    _blur_matrices[key] = m.astype(np.float32)
+  return _blur_matrices[key]
+
+def blur(x, sigma):
+  """
+  Blurs a batch of n,y,x,c images spatially, one matrix product per axis.
+  """
+  n,y,w,c = x.shape
+  t = np.tensordot(x, blur_matrix(sigma, w), axes=([2],[1]))             #n,y,c,x
+  return np.tensordot(blur_matrix(sigma, y), t, axes=([1],[1])).transpose([1,0,3,2])
+
+def difference_of_gaussians(x, sigma1, sigma2):
+  """
+  Blurs a batch of n,y,x,c images with sigma1 and sigma2 and returns the difference.
+  """
+  x = x.astype(np.float32, copy=False)
+  return blur(x, sigma1) - blur(x, sigma2)
+
+
+class Whitening(object):
+  """
+  ZCA whitening with a matrix fit by zca.py.
+  """
+
+  def __init__(self, filename):
+    self.zca = ZCA.load(filename)
+
+  def apply(self, x):
+    return self.zca.apply(x)
+
+
+class DifferenceOfGaussians(object):
+
+  def __init__(self, sigma1, sigma2):
+    self.sigma1 = sigma1
+    self.sigma2 = sigma2
+
+  def apply(self, x):
+    return difference_of_gaussians(x, self.sigma1, self.sigma2)
+
+
+class Standardize(object):
+  """
+  Subtracts a mean and divides by a standard deviation.
+  Either may be a scalar or per channel.  If neither is given each image is standardized by its own statistics.
+  """
+
+  def __init__(self, mean=None, std=None):
+    self.mean = mean
+    self.std = std
+
+  def apply(self, x):
+    if self.mean is None and self.std is None:
+      flat = x.reshape([len(x), -1])
+      mean = np.mean(flat, axis=1).reshape([-1,1,1,1])
+      std = np.std(flat, axis=1).reshape([-1,1,1,1])
+      return (x - mean)/(std + 1e-8)
+    mean = 0.0 if self.mean is None else np.asarray(self.mean, dtype=np.float32)
+    std = 1.0 if self.std is None else np.asarray(self.std, dtype=np.float32)
+    return (x - mean)/std
+
+
+class Chain(object):
+
+  def __init__(self, transforms):
+    self.transforms = transforms
+
+  def apply(self, x):
+    for t in self.transforms:
+      x = t.apply(x)
+    return x
+
+
+def load_transform(transform_param):
+  """
+  Builds the transform a provider applies to normalized, uncropped images, or None.
+  TRANSFORM_PARAM.zca_file, if set, whitens first, followed by the transforms in TRANSFORM_PARAM.transforms.
+  """
+  transforms = []
+  if getattr(transform_param, 'zca_file', ""):
+    transforms.append(Whitening(transform_param.zca_file))
+  transforms += list(getattr(transform_param, 'transforms', []))
+  if len(transforms) == 0:
+    return None
+  if len(transforms) == 1:
+    return transforms[0]
+  return Chain(transforms)
@@ -5,8 +5,9 @@ Created on Apr 27, 2016
 '''
 import numpy as np
 import weights_to_img as w2i
-from sys import path
+from os import path
 import math
+from itertools import chain
 
 
 def save_recon(data, column, columnuid, layeruid, save_path):
@@ -48,20 +49,53 @@ def save_top(data, column, columnuid,  layeruid, save_path):
 #       im = Image.fromarray(dp.denormalize(c[0,:]).astype(np.uint8).squeeze(),mode='L')
       im.save(save_path+'col'+str(columnuid)+'_level'+str(layeruid)+'_top.png')
       
-def save_embedding(column,dp,uid, save_path):
+def save_embeddings(columns, dp, save_path, prefix="embedding", holdout=None):
+  """
+  Streams the data provider once through every column and writes the flattened tops of each example.
+  Each column's embedding is written a minibatch at a time to a memory mapped <prefix>_col<n>.npy,
+  with the labels and keys of the examples, in the same order, in <prefix>_labels.npy and <prefix>_keys.npy.
+
+  @param: columns A list of AutoEncoders.  The n in a filename is the column's position in the list.
+  @param: dp The data provider to stream.  The final partial minibatch is included.
+  @param: save_path Directory the .npy files are written to.
+  @param: holdout The (data, labels, keys) returned by dp.split_holdout, or None.  Being the last examples of the dataset,
+    they are written after the provider's, so the embedding covers the whole dataset in order.
+  @return: The list of memory mapped embeddings, each [n_examples, top size].
+  """
   print("Saving embedding")
-  effective_examples = dp.get_n_examples() - dp.get_n_examples()%dp.shape()[0]
-  embedding = np.zeros((effective_examples,column.top_shape()[-1]))
-  labels = np.zeros((effective_examples), dtype = np.uint32)
+  n_examples = dp.get_n_examples()
+  batches = dp.get_mb(tail=True)
+  if holdout is not None:
+    n_examples += len(holdout[0])
+    batch_size = dp.shape()[0]
+    batches = chain(batches, (tuple(h[j:j+batch_size] for h in holdout) for j in range(0, len(holdout[0]), batch_size)))
+  embeddings = [np.lib.format.open_memmap(path.join(save_path, "{}_col{}.npy".format(prefix, c)), mode='w+', dtype=np.float32,
+                                          shape=(n_examples, int(np.prod(column.top_shape()[1:]))))
+                for c,column in enumerate(columns)]
+  labels = []
+  keys = []
   i = 0
-  mb_size = dp.shape()[0]
-  for mb in dp.get_mb():
-    embedding[i:i+mb_size,:] = column.encode_mb(mb[0])
-    labels[i:i+mb_size] = mb[1]
-  np.save(path.join(save_path,"embedding_level"+str(uid)), embedding)
-  np.save(path.join(save_path,"embedding_labels_level"+str(uid)), labels)
+  for mb in batches:
+    n = len(mb[0])
+    for column,embedding in zip(columns, embeddings):
+      embedding[i:i+n] = column.fwd(mb[0]).reshape([n, -1])
+    labels.append(mb[1])
+    keys += list(mb[2])
+    i += n
+  for embedding in embeddings:
+    embedding.flush()
+  np.save(path.join(save_path, prefix+"_labels.npy"), np.concatenate(labels))
+  np.save(path.join(save_path, prefix+"_keys.npy"), np.asarray(keys))
+  return embeddings
+
+def save_embedding(column,dp,uid, save_path, holdout=None):
+  return save_embeddings([column], dp, save_path, "embedding_level"+str(uid), holdout)[0]
     
-def get_label_batch(dp,label,n):
+def get_label_batch(dp,label,n,skip=0):
+  '''
+  Fills a minibatch with repeats of n examples of a label.
+  @param: skip Number of examples of the label to pass over first, so disjoint sets can be drawn.
+  '''
   data = np.zeros(dp.shape())
   examples_found = 0
   repeat = math.ceil(data.shape[0]/n)
@@ -74,9 +108,12 @@ def get_label_batch(dp,label,n):
       label_indices_i = 0
       while label_indices_i < len(label_indices) and examples_found < n:
         i = label_indices[label_indices_i]
+        label_indices_i += 1
+        if skip > 0:
+          skip -= 1
+          continue
         repeat =  min(repeat, data.shape[0]-data_i)
         data[data_i:data_i+repeat] = samples[i,:]
         data_i += repeat
         examples_found += 1
-        label_indices_i += 1
   return data
\ No newline at end of file
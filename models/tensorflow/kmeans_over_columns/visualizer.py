@@ -0,0 +1,95 @@
+"""
+Renders diagnostic mosaics off the training thread.
+
+A Renderer tiles and encodes images as they are submitted.
+A VisualizationWorker has the same interface but hands the arrays to a separate process over a bounded queue,
+dropping submissions while the backlog is full so training never waits on image encoding.
+Both visualize only every interval rounds.  Call tick() once per round to find out whether the round is due.
+"""
+
+import multiprocessing
+import Queue
+import weights_to_img as w2i
+
+
+def render(array, filename, normalize=False):
+  w2i.tile_imgs(array, normalize=normalize).save(filename)
+
+
+class Renderer(object):
+  """
+  Renders submitted arrays immediately.
+  """
+
+  def __init__(self, interval=1):
+    """
+    @param: interval Number of rounds between visualizations.
+    """
+    self.interval = interval
+    self.round = -1
+    self.dropped = 0
+
+  def tick(self):
+    """
+    Starts a new round.
+    @return: True if this round should be visualized.
+    """
+    self.round += 1
+    return self.round % self.interval == 0
+
+  def submit(self, array, filename, normalize=False):
+    """
+    Tiles an n,y,x,c array and writes it to filename as an image.
+    @return: True if the array will be rendered.
+    """
+    render(array, filename, normalize)
+    return True
+
+  def close(self):
+    pass
+
+
+def _serve(queue):
+  while True:
+    item = queue.get()
+    if item is None:
+      return
+    try:
+      render(*item)
+    except Exception as e:
+      print("Visualization of {} failed: {}".format(item[1], e))
+
+
+class VisualizationWorker(Renderer):
+  """
+  Renders submitted arrays in a separate process.
+  Start it before creating TensorFlow sessions so the process is not forked from them.
+  """
+
+  def __init__(self, interval=1, backlog=16):
+    """
+    @param: interval Number of rounds between visualizations.
+    @param: backlog Number of arrays that may wait to be rendered before further submissions are dropped.
+    """
+    Renderer.__init__(self, interval)
+    self.queue = multiprocessing.Queue(backlog)
+    self.process = multiprocessing.Process(target=_serve, args=(self.queue,))
+    self.process.daemon = True
+    self.process.start()
+
+  def submit(self, array, filename, normalize=False):
+    try:
+      self.queue.put_nowait((array, filename, normalize))
+      return True
+    except Queue.Full:
+      self.dropped += 1
+      return False
+
+  def close(self):
+    """
+    Waits for the backlog to be rendered and stops the process.
+    """
+    self.queue.put(None)
+    self.process.join()
+    if self.dropped > 0:
+      print("{} visualizations were dropped".format(self.dropped))
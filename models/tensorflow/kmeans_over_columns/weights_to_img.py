@@ -65,12 +65,9 @@ def tile_rgb_imgs(dat):
   imgs = np.ndarray([vertical_images_in_display*(y+1),horizontal_images_in_display*(x+1),3],dtype=np.uint8)
   imgs[:,:,:] = np.random.rand(*imgs.shape)*256 
   
-  for img_row in range(vertical_images_in_display):
-          for img in range(horizontal_images_in_display):
-              imgs[img_row*(y+1):(img_row+1)*(y+1)-1, \
-                   img*(x+1):(img+1)*(x+1)-1,\
-                   :] = \
-              dat[(img_row*horizontal_images_in_display+img),:,:,:]
+  #View the canvas as a grid of (y+1, x+1) cells and write every image into its cell at once
+  grid = imgs.reshape([vertical_images_in_display, y+1, horizontal_images_in_display, x+1, 3])
+  grid[:,:y,:,:x,:] = dat.reshape([vertical_images_in_display, horizontal_images_in_display, y, x, 3]).transpose([0,2,1,3,4])
   return Image.fromarray(imgs,mode='RGB')  
   
   
@@ -100,21 +97,14 @@ def tile_imgs(dat, normalize=False):
   if n > 1 and c == 3:
     return tile_rgb_imgs(dat)
 #   print "Display dimensions in images: ({},{})".format(horizontal_images_in_display, vertical_images_in_display)
-  dat = dat.transpose([0,3,1,2]) #n,c,y,x
-
-  imgs = np.ndarray([vertical_images_in_display*(y+1),horizontal_images_in_display*(x+1)],dtype=np.uint8)
-  imgs[:,:] = 0.0
-  for img_row in range(vertical_images_in_display):
-      for px_row in range(y):
-          for img in range(horizontal_images_in_display):
-              imgs[px_row+img_row*(y+1),\
-                   img*(x+1):(img+1)*(x+1)-1] = \
-              dat[(img_row*horizontal_images_in_display+img)/c,\
-                   (img_row*horizontal_images_in_display+img)%c ,\
-                   px_row,\
-                   :]
-              imgs[:,(img+1)*(x+1)-1] = minval
-      imgs[px_row+img_row*(y+1)+1,:] = minval
+  #Every channel of every image is a tile, in n,c order
+  tiles = dat.transpose([0,3,1,2]).reshape([vertical_images_in_display, horizontal_images_in_display, y, x])
+
+  #View the canvas as a grid of (y+1, x+1) cells whose last row and column are separators
+  imgs = np.ndarray([vertical_images_in_display, y+1, horizontal_images_in_display, x+1],dtype=np.uint8)
+  imgs[:] = minval
+  imgs[:,:y,:,:x] = tiles.transpose([0,2,1,3])
+  imgs = imgs.reshape([vertical_images_in_display*(y+1),horizontal_images_in_display*(x+1)])
   return Image.fromarray(imgs,mode = 'L')
 
 
@@ -6,33 +6,93 @@ Created on May 5, 2016
 
 import numpy as np
 import sys
-import cPickle
-from sklearn.decomposition import PCA
-import weights_to_img as w2i
-import matplotlib.pyplot as plt
+
+#Default whitening constant as a fraction of the mean eigenvalue of the covariance, so it does not depend on the scale of the data.
+#The providers fit in normalized space, e.g. pixels divided by 255, where an absolute constant such as 0.1 would swamp the spectrum.
+#This fraction matches 0.1 on raw 0-255 CIFAR pixels, whose variance is about 4000.
+RELATIVE_EPSILON = 2.5e-5
 
 def flatten_matrix(matrix):
     vector = matrix.flatten(1)
     vector = vector.reshape(1, len(vector))
     return vector
 
+
+class ZCA(object):
+  """
+  A ZCA whitening transform fit from a stream of chunks.
+
+  The covariance is accumulated chunk by chunk, merging each chunk's centered scatter with the running total,
+  so the data never has to be held in memory or upcast at once.
+  The whitening matrix and mean are saved to an .npz file and applied to minibatches by the data providers.
+  """
+
+  def __init__(self, matrix=None, mean=None):
+    self.matrix = matrix
+    self.mean = mean
+    self.epsilon = None
+
+  def fit(self, chunks, epsilon=None, dtype=np.float64):
+    """
+    @param: chunks An iterable of arrays [n, ...] holding the examples.
+    @param: epsilon Whitening constant added to the eigenvalues.  Prevents division by zero.
+                    If None, RELATIVE_EPSILON times the mean eigenvalue.
+    @param: dtype Type in which the covariance is accumulated, np.float32 or np.float64.
+    @return: self
+    """
+    n = 0
+    mean = None
+    scatter = None
+    for chunk in chunks:
+      x = chunk.reshape([len(chunk), -1]).astype(dtype)
+      m = len(x)
+      if m == 0:
+        continue
+      chunk_mean = np.mean(x, axis=0)
+      centered = x - chunk_mean
+      chunk_scatter = np.dot(centered.T, centered)
+      if mean is None:
+        mean = chunk_mean
+        scatter = chunk_scatter
+      else:
+        delta = chunk_mean - mean
+        scatter += chunk_scatter + np.outer(delta, delta)*(float(n)*m/(n+m))
+        mean += delta*(float(m)/(n+m))
+      n += m
+    sigma = scatter/n
+    #The covariance is symmetric so its eigenvectors give the rotation of the SVD
+    S,U = np.linalg.eigh(sigma)
+    S = np.maximum(S, 0)
+    if epsilon is None:
+      epsilon = RELATIVE_EPSILON*np.mean(S)
+    self.epsilon = epsilon
+    self.matrix = np.dot(U*(1.0/np.sqrt(S + epsilon)), U.T).astype(np.float32)
+    self.mean = mean.astype(np.float32)
+    return self
+
+  def save(self, filename):
+    with open(filename, 'wb') as fout:
+      np.savez(fout, matrix=self.matrix, mean=self.mean)
+
+  @staticmethod
+  def load(filename):
+    f = np.load(filename)
+    return ZCA(f['matrix'], f['mean'])
+
+  def apply(self, x):
+    """
+    Whitens a minibatch of examples of the shape the transform was fit on.
+    """
+    flat = x.reshape([len(x), -1]).astype(np.float32, copy=False)
+    return np.dot(flat - self.mean, self.matrix).reshape(x.shape)
+
+
 def zca_whitening(inputs):
-    sigma = np.dot(inputs.T, inputs)/inputs.shape[0] #Correlation matrix
-    U,S,V = np.linalg.svd(sigma) #Singular Value Decomposition
-    epsilon = 0.1                #Whitening constant, it prevents division by zero
-    S_diag = 1.0/np.sqrt(np.diag(S) + epsilon)
-    U_S = np.dot(U, S_diag)
-    ZCAMatrix = np.dot(U_S, U.T )    #ZCA Whitening matrix
-    print("U shape {}".format(U.shape))
-    print("S shape {}".format(S.shape))
-    print("U_S shape {}".format(U_S.shape))
-    print("S_diag shape {}".format(S_diag.shape))
-    print("ZCAMatrix shape {}".format(ZCAMatrix.shape))
-    print("inputs shape {}".format(inputs.shape))
-    return np.dot(inputs, ZCAMatrix )   #Data whitening
-  
-  
+    return ZCA().fit([inputs]).apply(inputs)
+
+
 def zca_whitening_sk(inputs):
+  from sklearn.decomposition import PCA
   pca = PCA(whiten=True)
   transformed = pca.fit_transform(inputs)
   pca.whiten = False
@@ -40,30 +100,18 @@ def zca_whitening_sk(inputs):
   return zca
 
 if __name__ == '__main__':
-    cifarpath = sys.argv[1]
-    with open(cifarpath, 'rb') as fi:
-      datadict = cPickle.load(fi)
-    data = datadict['data']
-    original_shape = data.shape
-    print("Original Data Shape {}".format(original_shape))
-    data = np.reshape(data,[len(data), -1])
-    white_data = zca_whitening(data)
-    comp = w2i.tile_imgs(np.transpose(
-                                      np.reshape(
-                                                 np.append(
-                                                           data[0,:], 
-                                                           white_data[0,:], 
-                                                           axis =0), 
-                                                 [2,3,32,32]
-                                                 )
-                                      ),
-                                      [0,2,3,1]
-                        )
-    plt.imshow(comp)
-    plt.show()
-    white_data = np.reshape(white_data,original_shape)
-    newdatadict = {'data':white_data,
-                   'labels':datadict['labels']}
-    with open("zca_cifar_data", 'w') as fo:
-      cPickle.dump(newdatadict, fo)
-    
\ No newline at end of file
+    if len(sys.argv) < 3:
+      print("Usage: python zca.py <output .npz file> <path to data> [<>]")
+      sys.exit(-1)
+    from column_definition import DATA_PARAM, TRANSFORM_PARAM, get_dp
+    #Fit in the space whitening is applied in: the normalized, uncropped images, before any other transform
+    DATA_PARAM.source = sys.argv[2:]
+    TRANSFORM_PARAM.zca_file = ""
+    TRANSFORM_PARAM.transforms = []
+    dp = get_dp(DATA_PARAM, TRANSFORM_PARAM)
+    data = dp.get_dataset()[0]
+    print("Fitting ZCA to data of shape {}".format(data.shape))
+    chunk = 1000
+    zca = ZCA().fit(data[i:i+chunk] for i in range(0, len(data), chunk))
+    zca.save(sys.argv[1])
+    print("ZCA matrix {} with epsilon {} saved to {}".format(zca.matrix.shape, zca.epsilon, sys.argv[1]))